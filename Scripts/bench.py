@@ -0,0 +1,251 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import cards
+import protocol
+import server
+
+# Microbenchmarks for the hot paths. Every benchmark builds its inputs from a fixed seed, is warmed up,
+# then timed over several repeats (the best repeat counts) and run once more under tracemalloc for its
+# allocation peak. Results are written as JSON and can be checked against an earlier run:
+#   python bench.py -o before.json
+#   python bench.py -o after.json --baseline before.json
+
+SEED = 1234
+INPUTS = 1000
+WARMUP_SECONDS = 0.2
+REPEATS = 5
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def random_hands(rng, size):
+    return [rng.sample(range(52), size) for _ in range(INPUTS)]
+
+
+def random_combos(rng):
+    # check_* functions take five Card objects in value order
+    return [sorted((cards.CARDS[card] for card in hand), key=lambda card: card.value)
+            for hand in random_hands(rng, 5)]
+
+
+# Each setup takes a seeded Random and returns (run, ops): run() does ops operations over prepared inputs
+
+@benchmark("evaluate_hand")
+def bench_evaluate_hand(rng):
+    hands = random_hands(rng, 7)
+
+    def run():
+        for hand in hands:
+            server.evaluate_hand(hand[:2], hand[2:])
+    return run, len(hands)
+
+
+@benchmark("evaluate_5")
+def bench_evaluate_5(rng):
+    hands = random_hands(rng, 5)
+
+    def run():
+        for hand in hands:
+            cards.evaluate(hand)
+    return run, len(hands)
+
+
+if cards.np is not None:
+    @benchmark("evaluate_batch")
+    def bench_evaluate_batch(rng):
+        hands = cards.np.array(random_hands(rng, 7), dtype=cards.np.uint8)
+
+        def run():
+            cards.evaluate_batch(hands)
+        return run, len(hands)
+
+
+def bench_check(check):
+    def setup(rng):
+        combos = random_combos(rng)
+
+        def run():
+            for combo in combos:
+                check(combo)
+        return run, len(combos)
+    return setup
+
+
+for _name in ("royal_flush", "straight_flush", "four_kind", "full_house", "flush", "straight", "three_kind",
+              "two_pair", "one_pair", "high_card"):
+    benchmark("check_" + _name)(bench_check(getattr(cards, "check_" + _name)))
+
+
+@benchmark("deck_new")
+def bench_deck_new(rng):
+    def run():
+        for _ in range(INPUTS):
+            cards.Deck()
+    return run, INPUTS
+
+
+@benchmark("deck_shuffle_deal")
+def bench_deck_shuffle_deal(rng):
+    deck = cards.Deck()
+    random.seed(rng.getrandbits(32))
+
+    def run():
+        for _ in range(INPUTS):
+            deck.shuffle_cards()
+            for _ in range(4):
+                deck.deal(2)
+            deck.deal(5)
+    return run, INPUTS
+
+
+@benchmark("card_print_str")
+def bench_card_print_str(rng):
+    deck = [cards.CARDS[card] for card in range(52)] * (INPUTS // 52 + 1)
+
+    def run():
+        for card in deck:
+            card.printStr()
+    return run, len(deck)
+
+
+@benchmark("print_cards")
+def bench_print_cards(rng):
+    hands = random_hands(rng, 5)
+
+    def run():
+        # Every hand is rendered from its glyphs, not looked up in the row cache warmed by earlier runs
+        cards.card_rows.cache_clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for hand in hands:
+                cards.print_cards(hand)
+    return run, len(hands)
+
+
+@benchmark("print_cards_cached")
+def bench_print_cards_cached(rng):
+    # The client redraws the same hand and board over and over, those rows come from the cache
+    hands = random_hands(rng, 5)[:10] * (INPUTS // 10)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for hand in hands:
+                cards.print_cards(hand)
+    return run, len(hands)
+
+
+@benchmark("encode_text")
+def bench_encode_text(rng):
+    messages = [f"It is player{rng.randint(1, 9)}'s turn" for _ in range(INPUTS)]
+
+    def run():
+        for message in messages:
+            protocol.encode(protocol.SERVER_MSG, protocol.SERVER_ID, message)
+    return run, len(messages)
+
+
+@benchmark("encode_cards")
+def bench_encode_cards(rng):
+    hands = random_hands(rng, 2)
+
+    def run():
+        for hand in hands:
+            protocol.encode(protocol.DEAL, protocol.SERVER_ID, hand)
+    return run, len(hands)
+
+
+@benchmark("decode_stream")
+def bench_decode_stream(rng):
+    # One turn worth of frames batched the way the server sends them, fed in uneven chunks
+    turn = protocol.encode_batch([protocol.encode(protocol.SERVER_MSG, protocol.SERVER_ID, "To call is 2"),
+                                  protocol.encode(protocol.SERVER_MSG, protocol.SERVER_ID, "You have 98 chips"),
+                                  protocol.encode(protocol.PROMPT, protocol.SERVER_ID, "OPTIONS:\n/fold\n/call"),
+                                  protocol.encode(protocol.ALERT, protocol.SERVER_ID, "")])
+    stream = turn * INPUTS
+    cuts = sorted(rng.sample(range(1, len(stream)), INPUTS // 4))
+    chunks = [stream[start:end] for start, end in zip([0] + cuts, cuts + [len(stream)])]
+
+    def run():
+        decoder = protocol.FrameDecoder()
+        for chunk in chunks:
+            decoder.feed(chunk)
+            for msg_type, sender, payload in decoder.frames():
+                protocol.decode_payload(msg_type, payload)
+    return run, INPUTS
+
+
+def measure(name, setup):
+    run, ops = setup(random.Random(SEED))
+    warmup_end = time.perf_counter() + WARMUP_SECONDS
+    while time.perf_counter() < warmup_end:
+        run()
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'ops_per_sec': ops / best, 'ops': ops, 'peak_bytes': peak}
+
+
+def compare(results, baseline, threshold):
+    # Returns the names of benchmarks that got slower than the baseline by more than threshold
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:24} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the evaluator, deck and protocol")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown that counts as a regression, 0.1 is 10%%")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter in name:
+            results[name] = measure(name, setup)
+            print(f"{name:24} {results[name]['ops_per_sec']:14,.0f} ops/s {results[name]['peak_bytes']:12,} B peak")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({'python': platform.python_version(), 'time': time.time(), 'seed': SEED, 'results': results},
+                      output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        print(f"Compared with {args.baseline}:")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import random
+
+import equity
+
+# Decisions for the server's own bot players. Preflop a bot looks its hand up in the preflop table when one has
+# been built, later streets are sampled in the equity process pool, so however long a bot thinks the event loop
+# only waits on a future. Whatever the pool has not finished within BUDGET_MS is dropped and the bot decides
+# on the samples it has, or plays safe with none. If the pool fails outright the bot plays safe as well, it
+# has to act either way or its seat would sit out the whole turn clock
+
+BUDGET_MS = 200
+SAMPLES = 2000
+STRONG = 0.6  # equity above which a bot puts chips in itself instead of only calling
+
+rng = random.Random()
+
+
+def pick(value, to_call, pot, chips, options):
+    # Returns (option, amount): bets and raises with a strong hand, calls when the equity beats the pot odds
+    strong = value > STRONG + rng.uniform(-0.1, 0.1)
+    size = max(1, pot // 2)
+    if strong and "bet" in options:
+        return "bet", min(size, chips)
+    if strong and "raise" in options and chips - to_call > 0:
+        return "raise", min(size, chips - to_call)
+    if to_call == 0:
+        return ("check" if "check" in options else "fold"), None
+    if value >= to_call / (pot + to_call):
+        if "call" in options:
+            return "call", None
+        if "all_in" in options:
+            # Calling would take every chip it has
+            return "all_in", None
+    return "fold", None
+
+
+async def decide(hole, board, opponents, to_call, pot, chips, options, preflop_table=None, budget_ms=BUDGET_MS):
+    try:
+        if not board and preflop_table is not None:
+            value = preflop_table.equity(hole, opponents)
+        else:
+            odds = await equity.estimate_equity_async(hole, board, opponents, budget_ms, SAMPLES)
+            value = 0.0 if odds is None else odds['equity']
+    except Exception as e:
+        print(f"Bot decision failed, playing safe: {e!r}")
+        value = 0.0
+    return pick(value, to_call, pot, chips, options)
@@ -1,44 +1,72 @@
 import random
+from array import array
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Cards are small ints: card = (value - 2) * 4 + suit index, so 0 is the 2♠ and 51 is the A♣
+SUITS = ("♠", "♥", "♦", "♣")
+VALUES = tuple(range(2, 15))
+SYMBOLS = {11: "J", 12: "Q", 13: "K", 14: "A"}
+SUIT_VALUES = {"♠": 4, "♥": 3, "♦": 2, "♣": 1}
+
+
+def card_id(value, suit):
+    return (value - 2) * 4 + SUITS.index(suit)
 
 
 class Deck:
+    __slots__ = ("cards", "position")
 
     def __init__(self):
-        suits = ["♠", "♥", "♦", "♣"]
-        values = [i for i in range(2, 15)]
-        self.cards = [Card(value, suit, False) for value in values for suit in suits]
+        # Card ids in deal order, everything before position has already been dealt
+        self.cards = array('B', range(52))
+        self.position = 0
 
     def __str__(self):
         to_print = ""
-        for card in self.cards:
-            to_print += card.printStr()
+        for card in self.cards[self.position:]:
+            to_print += CARDS[card].printStr()
         return to_print
 
     def add_card(self, value, suit):
-        self.cards.append(Card(value, suit, True))
+        self.cards.append(card_id(value, suit))
 
     def remove_card(self, card):
-        self.cards.pop(self.cards.index(card))
+        # Swap the card to the front of the undealt cards and skip over it
+        index = self.cards.index(card, self.position)
+        self.cards[index], self.cards[self.position] = self.cards[self.position], self.cards[index]
+        self.position += 1
 
     def deal(self, count):
-        dealt_cards = []
-        for i in range(count):
-            card = self.cards[0]
-            self.remove_card(card)
-            dealt_cards.append(card)
-        return dealt_cards
+        start = self.position
+        self.position += count
+        return self.cards[start:self.position].tolist()
 
     def shuffle_cards(self):
+        # Shuffling also gathers every dealt card back in, so one Deck can be reused for every hand
+        self.position = 0
         random.shuffle(self.cards)
 
 
 class Card:
+    __slots__ = ("value", "suit", "hidden")
+
     def __init__(self, value, suit, hidden):
         self.value = value
         self.suit = suit
         self.hidden = hidden
 
     def printStr(self):
+        # Every face and the back are drawn once at import, see GLYPHS
+        if self.hidden:
+            return GLYPHS[HIDDEN]
+        return GLYPHS[card_id(self.value, self.suit)]
+
+    def draw(self):
         symb = self.symbol()
         to_print = ""
         to_print += '┌─────────┐\n'
@@ -64,35 +92,24 @@ class Card:
         to_print += '└─────────┘\n'
         return to_print
 
-    def show_back(self):
-        self.hidden = True
-
-    def show_front(self):
-        self.hidden = False
-
     def __str__(self):
         return self.printStr()
 
     def symbol(self):
-        if self.value == 14:
-            return "A"
-        elif self.value == 13:
-            return "K"
-        elif self.value == 12:
-            return "Q"
-        elif self.value == 11:
-            return "J"
-        else:
-            return str(self.value)
+        return SYMBOLS.get(self.value, str(self.value))
 
     def suit_value(self):
-        if self.suit == "♠":
-            return 4
-        elif self.suit == "♥":
-            return 3
-        elif self.suit == "♦":
-            return 2
-        return 1
+        return SUIT_VALUES.get(self.suit, 0)
+
+
+# One shared card table, indexed by card id
+CARDS = tuple(Card(value, suit, False) for value in VALUES for suit in SUITS)
+CARD_VALUES = bytes(card.value for card in CARDS)
+
+# Pre-rendered boxes for the 52 faces plus the back, which print_cards takes as card id HIDDEN
+HIDDEN = 52
+GLYPHS = tuple(card.draw() for card in CARDS) + (Card(0, "", True).draw(),)
+GLYPH_LINES = tuple(tuple(glyph.split('\n')) for glyph in GLYPHS)
 
 
 def check_royal_flush(cards_comb):
@@ -171,14 +188,219 @@ def check_high_card(cards_comb):
     return 1
 
 
+@lru_cache(maxsize=1024)
+def card_rows(cards_tuple):
+    # The cards side by side, one string per line of the boxes (the last line is the blank gap under them)
+    if not cards_tuple:
+        return ('',) * len(GLYPH_LINES[0])
+    return tuple(''.join(GLYPH_LINES[card][line] + ' ' for card in cards_tuple)
+                 for line in range(len(GLYPH_LINES[0])))
+
+
 def print_cards(cards_list):
-    print_str = ""
-    print_str_list = []
-    for card in cards_list:
-        print_str_list.append(card.printStr().split('\n'))
-    for col in range(len(print_str_list[0])):
-        for row in range(len(print_str_list)):
-            print_str += print_str_list[row][col] + ' '
-        print_str += '\n'
-    print(print_str)
+    print(''.join(row + '\n' for row in card_rows(tuple(cards_list))))
+
+# Lookup-table hand evaluator
+# A hand of up to 7 cards is scored in a few table lookups:
+#   - if any suit holds 5+ cards, the bitmask of that suit's values indexes FLUSH_TABLE
+#     (with 7 cards a flush always beats every non-flush hand that is still possible)
+#   - otherwise the product of one prime per card value keys RANK_TABLE, which holds the
+#     best non-flush score for every multiset of values
+# Scores are comparable integers: (category << 20) followed by five 4-bit card values,
+# ordered the same way the old evaluator ordered them (by count, then by value).
+
+HIGH_CARD = 1
+ONE_PAIR = 2
+TWO_PAIR = 3
+THREE_KIND = 4
+STRAIGHT = 5
+FLUSH = 6
+FULL_HOUSE = 7
+FOUR_KIND = 8
+STRAIGHT_FLUSH = 9
+ROYAL_FLUSH = 10
+
+HAND_NAMES = {
+    HIGH_CARD: "high card",
+    ONE_PAIR: "1 pair",
+    TWO_PAIR: "2 pair",
+    THREE_KIND: "3 pair",
+    STRAIGHT: "straight",
+    FLUSH: "flush",
+    FULL_HOUSE: "full house",
+    FOUR_KIND: "4 pair",
+    STRAIGHT_FLUSH: "straight flush",
+    ROYAL_FLUSH: "royal flush"
+}
+
+VALUE_PRIMES = {2: 2, 3: 3, 4: 5, 5: 7, 6: 11, 7: 13, 8: 17, 9: 19, 10: 23, 11: 29, 12: 31, 13: 37, 14: 41}
+
+
+def make_score(category, values):
+    score = category
+    for value in values:
+        score = (score << 4) | value
+    return score << (4 * (5 - len(values)))
+
+
+def hand_category(score):
+    return score >> 20
+
+
+def hand_name(score):
+    return HAND_NAMES[hand_category(score)]
+
+
+def _straight_top(value_mask):
+    # value_mask has bit (value - 2) set for every value present
+    for top in range(14, 5, -1):
+        run = 0b11111 << (top - 6)
+        if value_mask & run == run:
+            return top
+    # Wheel: A 2 3 4 5
+    if value_mask & 0b1000000001111 == 0b1000000001111:
+        return 5
+    return 0
 
+
+def _straight_values(top):
+    return [top - i if top - i > 1 else 14 for i in range(5)]
+
+
+def _flush_score(value_mask):
+    top = _straight_top(value_mask)
+    if top == 14:
+        return make_score(ROYAL_FLUSH, _straight_values(top))
+    if top:
+        return make_score(STRAIGHT_FLUSH, _straight_values(top))
+    values = [value for value in range(14, 1, -1) if value_mask & (1 << (value - 2))]
+    return make_score(FLUSH, values[:5])
+
+
+def _rank_score(groups):
+    # groups holds a (count, value) pair for every value in the hand, largest first
+    value_mask = 0
+    for count, value in groups:
+        value_mask |= 1 << (value - 2)
+
+    best_count, best = groups[0]
+    kickers = [value for count, value in groups[1:]]
+    # Hands of fewer than 5 cards (before the river) score with fewer kickers
+    if best_count == 4:
+        return make_score(FOUR_KIND, [best] * 4 + ([max(kickers)] if kickers else []))
+    if best_count == 3 and len(groups) > 1 and groups[1][0] >= 2:
+        pair = max(value for count, value in groups[1:] if count >= 2)
+        return make_score(FULL_HOUSE, [best] * 3 + [pair] * 2)
+    top = _straight_top(value_mask)
+    if top:
+        return make_score(STRAIGHT, _straight_values(top))
+    if best_count == 3:
+        return make_score(THREE_KIND, [best] * 3 + kickers[:2])
+    if best_count == 2:
+        if len(groups) > 1 and groups[1][0] == 2:
+            return make_score(TWO_PAIR, [best] * 2 + [kickers[0]] * 2 + ([max(kickers[1:])] if kickers[1:] else []))
+        return make_score(ONE_PAIR, [best] * 2 + kickers[:3])
+    return make_score(HIGH_CARD, [best] + kickers[:4])
+
+
+def _build_tables(sizes):
+    flush_table = [0] * (1 << 13)
+    for value_mask in range(1 << 13):
+        if bin(value_mask).count("1") >= 5:
+            flush_table[value_mask] = _flush_score(value_mask)
+
+    rank_table = {}
+    max_size = max(sizes)
+
+    def fill(value, groups, size, product):
+        if size + 4 * (value - 1) < min(sizes):
+            return
+        if value == 1:
+            if size in sizes:
+                rank_table[product] = _rank_score(sorted(groups, reverse=True))
+            return
+        fill(value - 1, groups, size, product)
+        for count in range(1, min(4, max_size - size) + 1):
+            product *= VALUE_PRIMES[value]
+            groups.append((count, value))
+            fill(value - 1, groups, size + count, product)
+            groups.pop()
+
+    fill(14, [], 0, 1)
+    return flush_table, rank_table
+
+
+FLUSH_TABLE, RANK_TABLE = _build_tables((2, 3, 4, 5, 6, 7))
+CARD_PRIMES = tuple(VALUE_PRIMES[value] for value in CARD_VALUES)
+CARD_BITS = tuple(1 << (value - 2) for value in CARD_VALUES)
+
+
+def evaluate(cards_list):
+    # Scores the best 5 card hand out of 2 to 7 card ids
+    product = 1
+    suit_masks = [0, 0, 0, 0]
+    for card in cards_list:
+        product *= CARD_PRIMES[card]
+        suit_masks[card & 3] |= CARD_BITS[card]
+    for value_mask in suit_masks:
+        if FLUSH_TABLE[value_mask]:
+            return FLUSH_TABLE[value_mask]
+    return RANK_TABLE[product]
+
+
+class HandState:
+    # One player's cards so far, for scoring street by street: add() folds in only the new cards
+    # and keeps score up to date, so reading the best hand at any point (showdown included) costs nothing
+
+    __slots__ = ("product", "suit_masks", "score")
+
+    def __init__(self, cards_list):
+        self.product = 1
+        self.suit_masks = [0, 0, 0, 0]
+        self.score = 0
+        self.add(cards_list)
+
+    def add(self, cards_list):
+        for card in cards_list:
+            self.product *= CARD_PRIMES[card]
+            self.suit_masks[card & 3] |= CARD_BITS[card]
+        for value_mask in self.suit_masks:
+            if FLUSH_TABLE[value_mask]:
+                self.score = FLUSH_TABLE[value_mask]
+                return
+        self.score = RANK_TABLE[self.product]
+
+
+_batch_tables = None
+
+
+def _numpy_tables():
+    # The lookup tables as arrays: rank table keys are sorted so a whole batch can be found with searchsorted
+    global _batch_tables
+    if _batch_tables is None:
+        products = sorted(RANK_TABLE)
+        _batch_tables = (
+            np.array(products, dtype=np.int64),
+            np.array([RANK_TABLE[product] for product in products], dtype=np.int32),
+            np.array(FLUSH_TABLE, dtype=np.int32),
+            np.array(CARD_PRIMES, dtype=np.int64),
+            np.array(CARD_BITS, dtype=np.int32)
+        )
+    return _batch_tables
+
+
+def evaluate_batch(hands):
+    # Scores an (N, 5 to 7) array of card ids at once, returns N scores matching evaluate
+    if np is None:
+        raise ImportError("evaluate_batch requires numpy")
+    products, scores, flush_table, card_primes, card_bits = _numpy_tables()
+    hands = np.asarray(hands, dtype=np.intp)
+
+    result = scores[np.searchsorted(products, card_primes[hands].prod(axis=1))]
+    suits = hands & 3
+    bits = card_bits[hands]
+    for suit in range(4):
+        suit_masks = np.bitwise_or.reduce(np.where(suits == suit, bits, 0), axis=1)
+        # A flush always beats the best non-flush hand of the same cards
+        np.maximum(result, flush_table[suit_masks], out=result)
+    return result
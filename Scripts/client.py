@@ -1,26 +1,48 @@
+import queue
+import shutil
 import socket
 import sys
 import threading
 import cards
-import pickle
+import preflop
+import protocol
 import time
 
 
-HEADER_LENGTH = 10
+SERVER = ('172.105.98.201', 7976)
+# Seconds to wait before each attempt to get back to our seat after the connection drops
+RECONNECT_DELAYS = (1, 2, 4, 8, 16)
 
 nickname = input("Choose your nickname: ")
 
 client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # socket initialization
-client.connect(('172.105.98.201', 7976))  # connecting client to server
+client.connect(SERVER)  # connecting client to server
 
-nickname = nickname.encode('utf-8')
-nickname_header = f"{len(nickname):<{HEADER_LENGTH}}".encode('utf-8')
-client.send(nickname_header + nickname)
+client.send(protocol.encode(protocol.HELLO, protocol.SERVER_ID, nickname))
 
 is_open = True
+# Sent by the server after HELLO, proves who we are when reconnecting
+token = None
+# Names of everyone who can send us messages, by sender id
+players = {protocol.SERVER_ID: "Server"}
+preflop_table = preflop.load()
 community = []
 hand = []
 
+# Decoded messages waiting to be shown. The receive thread only reads the socket, the render thread prints
+# and does the pausing, so a slow display never backs up the connection
+render_queue = queue.Queue()
+PACE = 0.75  # seconds to leave a server message on screen
+CATCH_UP = 10  # skip the pauses while more messages than this are waiting
+
+# With --ansi the cards stay in fixed regions at the top of the terminal and only a region whose cards changed
+# is rewritten in place, with cursor addressing. Messages scroll in the region underneath
+ANSI = "--ansi" in sys.argv
+HAND_TOP = 1
+COMMUNITY_TOP = HAND_TOP + len(cards.GLYPH_LINES[0])
+SCROLL_TOP = COMMUNITY_TOP + len(cards.GLYPH_LINES[0]) + 1
+shown = {}
+
 
 def format_server_msg(text):
     box = "--                                                                                --"
@@ -33,68 +55,162 @@ def format_prompt(text):
     return "~~~~~~~~\n" + text + "\n~~~~~~~~\n"
 
 
+def setup_screen():
+    height = shutil.get_terminal_size().lines
+    # Clear, draw the divider, limit scrolling to the rows below it and move the cursor there
+    sys.stdout.write(f"\x1b[2J\x1b[{SCROLL_TOP - 1};1H{'─' * 40}\x1b[{SCROLL_TOP};{height}r\x1b[{SCROLL_TOP};1H")
+    sys.stdout.flush()
+
+
+def draw_region(top, title, card_ids):
+    if shown.get(top) == card_ids:
+        return
+    shown[top] = card_ids
+    # Save the cursor, rewrite the title and card rows in place, then put the cursor back
+    out = "\x1b7"
+    for offset, line in enumerate((title,) + cards.card_rows(card_ids)[:-1]):
+        out += f"\x1b[{top + offset};1H\x1b[2K{line}"
+    sys.stdout.write(out + "\x1b8")
+    sys.stdout.flush()
+
+
+def show_snapshot(snapshot):
+    global hand
+    global community
+    hand = snapshot['hole']
+    community = snapshot['board']
+    if ANSI:
+        draw_region(HAND_TOP, "Your hand:", tuple(hand))
+        draw_region(COMMUNITY_TOP, "Community cards:", tuple(community))
+    elif hand:
+        print("Your hand:")
+        cards.print_cards(hand)
+        print("Community cards:")
+        cards.print_cards(community)
+    print(format_server_msg(f"Table {snapshot['table']}, pot {snapshot['pot']}, bet {snapshot['current_bet']}"))
+    for player_id, chips, in_for, flags in snapshot['seats']:
+        status = "in hand" if flags & protocol.IN_HAND else "waiting"
+        if flags & protocol.BOT:
+            status += ", bot"
+        if flags & protocol.DISCONNECTED:
+            status += ", disconnected"
+        print(f"  {players.get(player_id, '?')}: {chips} chips, {in_for} in ({status})")
+    if snapshot['acting']:
+        print(f"  {players.get(snapshot['acting'], '?')} to act, {snapshot['time_left_ms'] / 1000:.0f}s left")
+
+
+def process_message(message_title, sender, message_data):
+    global hand
+    global community
+    if message_title == protocol.PLAYER:
+        players[sender] = message_data
+    elif message_title == protocol.TEXT:
+        # Print message
+        print(f'{players.get(sender, "?")} > {message_data}')
+    elif message_title == protocol.SERVER_MSG:
+        print(format_server_msg(message_data))
+    elif message_title == protocol.DEAL:
+        hand = message_data
+        community = []
+        if ANSI:
+            draw_region(HAND_TOP, "Your hand:", tuple(hand))
+            draw_region(COMMUNITY_TOP, "Community cards:", ())
+        else:
+            print("Dealt Hand:")
+            cards.print_cards(hand)
+        if preflop_table:
+            print(f"Preflop equity heads up: {preflop_table.equity(hand, 1):.1%}")
+    elif message_title == protocol.COMMUNITY:
+        if len(message_data) == 3:
+            # The flop starts a new board, spectators never get a DEAL to clear the last one
+            community = []
+        community += message_data
+        if ANSI:
+            draw_region(COMMUNITY_TOP, "Community cards:", tuple(community))
+        else:
+            if hand:
+                print("Your hand:")
+                cards.print_cards(hand)
+            print("Community cards:")
+            cards.print_cards(community)
+    elif message_title == protocol.ALERT:
+        print('\a')
+    elif message_title == protocol.PROMPT:
+        print(format_prompt(message_data))
+    elif message_title == protocol.SNAPSHOT:
+        show_snapshot(message_data)
+
+
+def render():
+    while True:
+        message = render_queue.get()
+        if message is None:
+            break
+        process_message(*message)
+        if message[0] == protocol.SERVER_MSG and render_queue.qsize() < CATCH_UP:
+            time.sleep(PACE)
+    if ANSI:
+        # Give the whole terminal back
+        sys.stdout.write("\x1b[r")
+        sys.stdout.flush()
+
+
+def reconnect():
+    # Opens a new connection and asks for our old session back, True once the RESUME is sent
+    global client
+    for delay in RECONNECT_DELAYS:
+        render_queue.put((protocol.SERVER_MSG, protocol.SERVER_ID, f"Connection lost, retrying in {delay}s"))
+        time.sleep(delay)
+        if not is_open:
+            return False
+        try:
+            new_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            new_client.connect(SERVER)
+            new_client.send(protocol.encode(protocol.RESUME, protocol.SERVER_ID, token))
+        except OSError:
+            continue
+        client = new_client
+        return True
+    return False
+
+
 def receive():
+    global token
+    decoder = protocol.FrameDecoder()
     try:
         while True:
             # all sent messages will have a title and data
             global is_open
             if not is_open:
                 break
-            # Receive our "header" containing username length, it's size is defined and constant
-            sender_header = client.recv(HEADER_LENGTH)
+            # Read whatever has arrived, it can hold several frames or only part of one
             # If we received no data, server gracefully closed a connection, for example using socket.close() or
             # socket.shutdown(socket.SHUT_RDWR)
-            if not len(sender_header):
-                print('Connection closed by the server')
-                sys.exit()
-
-            # Convert header to int value
-            sender_length = int(sender_header[:HEADER_LENGTH])
-
-            # Receive and decode sender's username
-            sender = client.recv(sender_length)
-            sender = pickle.loads(sender)
-
-            # Now do the same for the message
-            message_header = client.recv(HEADER_LENGTH)
-            message_length = int(message_header[:HEADER_LENGTH])
-            message = client.recv(message_length)
-            message = pickle.loads(message)
-
-            message_title = message['title']
-            message_data = message['data']
-
-            if message_title == "TEXT":
-                # Print message
-                print(f'{sender} > {message_data}')
-            elif message_title == "SERVER-MSG":
-                print(format_server_msg(message_data))
-                time.sleep(0.75)
-            elif message_title == "DEAL":
-                print("Dealt Hand:")
-                global hand
-                hand = message_data
-                cards.print_cards(hand)
-            elif message_title == "COMMUNITY":
-                global community
-                if len(community) == 5:
-                    community = []
-                community += message_data
-                print("Your hand:")
-                cards.print_cards(hand)
-                print("Community cards:")
-                cards.print_cards(community)
-            elif message_title == "ALERT":
-                print('\a')
-            elif message_title == "PROMPT":
-                print(format_prompt(message_data))
+            try:
+                received = decoder.recv(client)
+            except OSError:
+                received = 0
+            if not received:
+                if is_open and token and reconnect():
+                    # Start clean, a frame cut off by the old connection is lost with it
+                    decoder = protocol.FrameDecoder()
+                    continue
+                if is_open:
+                    render_queue.put((protocol.SERVER_MSG, protocol.SERVER_ID, "Connection closed by the server"))
+                break
 
+            for message_title, sender, payload in decoder.frames():
+                if message_title == protocol.SESSION:
+                    token = str(payload, 'utf-8')
+                    continue
+                render_queue.put((message_title, sender, protocol.decode_payload(message_title, payload)))
 
     except Exception as e:
         print("An error occured!")
         e = sys.exc_info()[0]
         print("Error: %s" % e)
         client.close()
+    render_queue.put(None)
 
 
 def write():
@@ -103,16 +219,26 @@ def write():
         if message == "/quit":
             global is_open
             is_open = False
+            # Tell the server first, otherwise it keeps our seat waiting for us to come back
+            try:
+                client.send(protocol.encode(protocol.INPUT, protocol.SERVER_ID, message))
+            except OSError:
+                pass
             client.close()
             break
         if message:
-            # Encode message to bytes, prepare header and convert to bytes, like for username above, then send
-            message = message.encode('utf-8')
-            message_header = f"{len(message):<{HEADER_LENGTH}}".encode('utf-8')
-            client.send(message_header + message)
+            # Encode message to bytes behind a header, like for username above, then send
+            try:
+                client.send(protocol.encode(protocol.INPUT, protocol.SERVER_ID, message))
+            except OSError:
+                print(format_server_msg("Not connected, message not sent"))
 
 
+if ANSI:
+    setup_screen()
 receive_thread = threading.Thread(target=receive)  # thread to receive messages
 receive_thread.start()
+render_thread = threading.Thread(target=render)  # thread to print them
+render_thread.start()
 write_thread = threading.Thread(target=write)  # thread to send messages
 write_thread.start()
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cards
+
+CHUNK_SAMPLES = 1000
+
+_executor = None
+
+
+def get_executor():
+    # One pool of worker processes shared by every equity estimate in this process. Workers are not forked from
+    # the server itself: a fork copies its sockets and can catch another thread holding a lock, the console
+    # thread sits in input() holding stdin's, which the new worker then waits on forever
+    global _executor
+    if _executor is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _executor = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+def start_pool():
+    # Starts every worker now: a cold pool spends longer starting processes and importing cards than an estimate
+    # gets, so the first ones would all come back empty
+    executor = get_executor()
+    for _ in range(os.cpu_count()):
+        executor.submit(simulate, [], [], 0, 0, 0)
+
+
+def simulate(hole, board, opponents, samples, seed):
+    # Deals out the rest of the board and the opponents' hands samples times,
+    # returns [wins, ties, equity] where a tie for the pot between k players adds 1/k equity
+    rng = random.Random(seed)
+    dead = set(hole) | set(board)
+    deck = [card for card in range(52) if card not in dead]
+    needed = 5 - len(board)
+    draw = needed + 2 * opponents
+    wins = ties = 0
+    equity = 0.0
+    for _ in range(samples):
+        drawn = rng.sample(deck, draw)
+        full_board = board + drawn[:needed]
+        mine = cards.evaluate(hole + full_board)
+        tied = 1
+        for start in range(needed, draw, 2):
+            theirs = cards.evaluate(drawn[start:start + 2] + full_board)
+            if theirs > mine:
+                break
+            if theirs == mine:
+                tied += 1
+        else:
+            if tied == 1:
+                wins += 1
+            else:
+                ties += 1
+            equity += 1 / tied
+    return [wins, ties, equity]
+
+
+def _submit(hole, board, opponents, samples):
+    # None when the pool is broken
+    global _executor
+    futures = {}
+    executor = get_executor()
+    try:
+        for start in range(0, samples, CHUNK_SAMPLES):
+            count = min(CHUNK_SAMPLES, samples - start)
+            futures[executor.submit(simulate, list(hole), list(board), opponents, count,
+                                    random.getrandbits(32))] = count
+    except BrokenProcessPool:
+        # A worker died (killed for memory, say) and the pool takes no more work. Its replacement starts right
+        # away so the next estimate finds it warm
+        if _executor is executor:
+            _executor = None
+            start_pool()
+        executor.shutdown(wait=False)
+        return None
+    return futures
+
+
+def _collect(futures, done):
+    wins = ties = total = 0
+    equity = 0.0
+    for future in futures:
+        if future not in done:
+            future.cancel()
+            continue
+        if future.cancelled() or future.exception() is not None:
+            # Lost with its worker, _submit replaces the pool
+            continue
+        chunk_wins, chunk_ties, chunk_equity = future.result()
+        wins += chunk_wins
+        ties += chunk_ties
+        equity += chunk_equity
+        total += futures[future]
+    if total == 0:
+        return None
+    return {'win': wins / total, 'tie': ties / total, 'equity': equity / total, 'samples': total}
+
+
+def estimate_equity(hole, board, opponents, deadline_ms=500, samples=20000):
+    # Samples in chunks across the process pool and returns whatever finished before the deadline
+    # as {'win', 'tie', 'equity', 'samples'}, or None when no chunk finished in time or the pool is broken. With
+    # no opponents left the hand is already won, 'samples' is 0 then
+    if opponents == 0:
+        return {'win': 1.0, 'tie': 0.0, 'equity': 1.0, 'samples': 0}
+    futures = _submit(hole, board, opponents, samples)
+    if futures is None:
+        return None
+    done, pending = wait(futures, timeout=deadline_ms / 1000)
+    return _collect(futures, done)
+
+
+async def estimate_equity_async(hole, board, opponents, deadline_ms=500, samples=20000):
+    # Same as estimate_equity, but waits on the event loop instead of blocking a thread
+    if opponents == 0:
+        return {'win': 1.0, 'tie': 0.0, 'equity': 1.0, 'samples': 0}
+    futures = _submit(hole, board, opponents, samples)
+    if futures is None:
+        return None
+    waiters = {asyncio.wrap_future(future): future for future in futures}
+    done, pending = await asyncio.wait(waiters, timeout=deadline_ms / 1000)
+    for waiter in pending:
+        waiter.cancel()
+    for waiter in done:
+        if not waiter.cancelled():
+            # Marks a chunk lost with its worker as seen, _collect leaves it out
+            waiter.exception()
+    return _collect(futures, {waiters[waiter] for waiter in done})
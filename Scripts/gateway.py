@@ -0,0 +1,247 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import zlib
+
+import matchmaker
+import protocol
+
+# Multi-process mode: python server.py --workers N
+# This process only owns the listening port. It reads the first frame of every connection (HELLO or RESUME),
+# then passes the socket itself to one of N worker processes over a Unix socket and forgets about it. Each
+# worker is a whole server.py event loop with its own tables, so every table, and everyone playing at it, lives
+# in exactly one process and games on different cores never share a GIL. Players only meet at tables of their
+# own worker, so new players fill the first worker with room (--capacity, two tables by default) before the
+# next one gets any, and the least loaded worker once all are full. Small enough that load spreads over the
+# cores once a worker's tables fill, large enough that its lobby and queue still make tables. A RESUME goes
+# back to the worker that issued the token (its first byte, see server.Session). A worker that exits or stops
+# taking packets gets nothing more, its players have to log in again on another one.
+#
+# Each worker has one SOCK_SEQPACKET control socket to this process, every message is one packet starting with
+#   HANDOFF   gateway -> worker, the rest is what was read from the connection so far, its fd is attached
+#   RELAY     worker -> gateway -> every other worker, the rest is a frame for the lobby (chat, names)
+#   ADMIN     gateway -> worker, the rest is a line typed into the console here. Commands for one table only go
+#             to the worker hosting it, /add_chips only to the worker the player is on (any if offline)
+#   LOAD      worker -> gateway, the rest is how many clients it has, in ASCII digits
+#   NAME      worker -> gateway, "<request> <nickname>" for a player logging in, answered with the same request
+#             number and the name they get, with a ' added for as long as it is taken on any worker
+#   RELEASE   worker -> gateway, the rest is a nickname that is free again
+# A packet never carries more than PACKET_SIZE bytes: a longer one would be cut short on the way. Connections
+# whose first read does not fit are closed, lobby frames that do not fit are not relayed (see server.relay)
+
+HANDOFF = b"C"
+RELAY = b"F"
+ADMIN = b"A"
+LOAD = b"L"
+NAME = b"N"
+RELEASE = b"R"
+PACKET_SIZE = 1 << 17
+MAX_RELAYED = PACKET_SIZE - len(RELAY) - protocol.HEADER.size  # largest payload a relayed frame can have
+CAPACITY = 2 * matchmaker.TABLE_SIZE  # default for --capacity, clients a worker takes before the next one gets any
+
+TABLE_COMMANDS = ("/start", "/bots", "/end")  # console commands whose second word is a table id
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def table_worker(table_id, count):
+    # The worker hosting a table: server.new_table numbers them so id n is on worker (n - 1) % count, any other
+    # id goes by its checksum
+    if table_id.isdigit() and int(table_id) > 0:
+        return (int(table_id) - 1) % count
+    return zlib.crc32(table_id.encode('utf-8')) % count
+
+
+class Handoff(asyncio.Protocol):
+    # Holds a new connection just long enough to see its first frame
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.transport = None
+        self.data = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data += data
+        if len(self.data) < protocol.HEADER.size:
+            return
+        version, msg_type, sender, length = protocol.HEADER.unpack_from(self.data)
+        if version != protocol.VERSION or len(HANDOFF) + protocol.HEADER.size + length > PACKET_SIZE:
+            self.transport.close()
+            return
+        if len(self.data) < protocol.HEADER.size + length:
+            return
+        # Whatever arrives from now on stays in the socket for the worker to read
+        self.transport.pause_reading()
+        first = self.data[protocol.HEADER.size:protocol.HEADER.size + length]
+        self.gateway.hand_off(self.transport, self.data, msg_type, first)
+
+
+class Gateway:
+
+    def __init__(self, count, capacity=CAPACITY):
+        self.capacity = capacity
+        self.controls = []
+        self.workers = []
+        self.loads = [0] * count
+        self.alive = [True] * count
+        # Nicknames in use on any worker, by the worker they are on. A player on two workers at once would have
+        # the same bankroll loaded twice, and whichever saved last would win
+        self.names = {}
+        self.names_lock = threading.Lock()
+        self.loop = None
+        self.server = None
+        for index in range(count):
+            ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self.workers.append(subprocess.Popen([sys.executable, SERVER_PATH, "--worker", str(index), str(count),
+                                                  str(theirs.fileno())], pass_fds=[theirs.fileno()],
+                                                 stdin=subprocess.DEVNULL))
+            theirs.close()
+            self.controls.append(ours)
+
+    def pick(self, msg_type, first):
+        # None once every worker is gone
+        if msg_type == protocol.RESUME:
+            try:
+                index = int(str(first[:2], 'ascii'), 16)
+            except ValueError:
+                index = None
+            if index is not None and index < len(self.controls) and self.alive[index]:
+                return index
+        running = [index for index in range(len(self.controls)) if self.alive[index]]
+        for index in running:
+            if self.loads[index] < self.capacity:
+                return index
+        return min(running, key=lambda index: self.loads[index], default=None)
+
+    def drop(self, index):
+        # Called from whichever thread notices first that a worker is gone
+        with self.names_lock:
+            if not self.alive[index]:
+                return
+            self.alive[index] = False
+            self.names = {name: owner for name, owner in self.names.items() if owner != index}
+        print(f"Worker {index} exited")
+
+    def send(self, index, packet):
+        if not self.alive[index]:
+            return
+        try:
+            self.controls[index].send(packet)
+        except OSError:
+            self.drop(index)
+
+    def hand_off(self, transport, data, msg_type, first):
+        if len(HANDOFF) + len(data) > PACKET_SIZE:
+            # More arrived behind the first frame than one packet can take
+            transport.close()
+            return
+        index = self.pick(msg_type, first)
+        if index is None:
+            transport.close()
+            return
+        # Counted until the worker reports its own number, so a burst of connections does not all go to one
+        self.loads[index] += 1
+        try:
+            socket.send_fds(self.controls[index], [HANDOFF + data], [transport.get_extra_info('socket').fileno()])
+        except OSError as e:
+            print(f"Could not hand a connection to worker {index}: {e}")
+            self.drop(index)
+        # The worker has its own copy of the socket now, closing ours leaves the connection open
+        transport.close()
+
+    def relay(self, index):
+        # Runs on its own thread per worker, passing lobby frames on to every other worker
+        control = self.controls[index]
+        while True:
+            try:
+                packet = control.recv(PACKET_SIZE)
+            except OSError:
+                return
+            if not packet:
+                self.drop(index)
+                return
+            if packet[:1] == RELAY:
+                for other in range(len(self.controls)):
+                    if other != index:
+                        self.send(other, packet)
+            elif packet[:1] == LOAD:
+                self.loads[index] = int(packet[1:])
+            elif packet[:1] == NAME:
+                request, name = str(packet[1:], 'utf-8').split(" ", 1)
+                with self.names_lock:
+                    while name in self.names:
+                        name += "'"
+                    self.names[name] = index
+                self.send(index, NAME + f"{request} {name}".encode('utf-8'))
+            elif packet[:1] == RELEASE:
+                name = str(packet[1:], 'utf-8')
+                with self.names_lock:
+                    if self.names.get(name) == index:
+                        del self.names[name]
+
+    def admin(self):
+        while True:
+            try:
+                line = input()
+                args = line.split()
+                targets = range(len(self.controls))
+                if line == "/add_chips":
+                    # Asked for here so the chips are added once, by the worker that has the player or the store
+                    print("To who?")
+                    name = input()
+                    print("How much? (#)")
+                    line = f"/add_chips {name} {input()}"
+                    with self.names_lock:
+                        index = self.names.get(name)
+                    if index is None:
+                        # Offline, any worker that is still running can add them in the store
+                        index = next((index for index in range(len(self.controls)) if self.alive[index]), 0)
+                    targets = [index]
+                elif len(args) > 1 and args[0] in TABLE_COMMANDS:
+                    targets = [table_worker(args[1], len(self.controls))]
+            except EOFError:
+                break
+            packet = ADMIN + line.encode('utf-8')
+            if len(packet) > PACKET_SIZE:
+                print("Line too long")
+                continue
+            for index in targets:
+                self.send(index, packet)
+            if line == "/shutdown":
+                # The workers finish up on their own, stop taking new connections
+                self.loop.call_soon_threadsafe(self.server.close)
+                break
+
+    async def serve(self, host, port):
+        for index in range(len(self.controls)):
+            threading.Thread(target=self.relay, args=(index,), daemon=True).start()
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(lambda: Handoff(self), host, port)
+        threading.Thread(target=self.admin, daemon=True).start()
+        print(f"Gateway listening, {len(self.controls)} workers")
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        for worker in self.workers:
+            try:
+                worker.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                worker.terminate()
+                worker.wait()
+
+
+def run(count, host, port, capacity=CAPACITY):
+    gateway = Gateway(count, capacity)
+    try:
+        asyncio.run(gateway.serve(host, port))
+    finally:
+        gateway.stop()
@@ -0,0 +1,199 @@
+import glob
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+import cards
+
+# Append-only hand history. Every finished hand is one record: a 4 byte length followed by the encoded hand
+#   HAND                      start time, hand number, pot, number of seats, board cards and actions
+#   table id                  1 byte length + UTF-8
+#   seats   x SEAT + name     client id, chips before the blinds, the two hole cards, 1 byte length + UTF-8 name
+#   board                     one byte per card id (see cards.py)
+#   actions x ACTION          time, client id, index into ACTIONS, chips put in
+#   winners                   1 byte count, then WINNER for each: client id, chips won
+# Records are appended to numbered segment files by a background thread, a new segment is started on every
+# server start and whenever the current one passes SEGMENT_BYTES. Read them back with
+#   python history.py [directory]
+
+MAGIC = b"HNDS"
+VERSION = 1
+FILE_HEADER = struct.Struct("!4sH")
+RECORD = struct.Struct("!I")
+HAND = struct.Struct("!dIiBBH")
+SEAT = struct.Struct("!HiBB")
+ACTION = struct.Struct("!dHBi")
+WINNER = struct.Struct("!Hi")
+TEXT = struct.Struct("!B")
+
+ACTIONS = ("call", "raise", "fold", "all_in", "check", "bet", "small_blind", "big_blind", "leave")
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hands")
+SEGMENT_BYTES = 16 << 20
+
+
+def new_hand(table_id, number, seats):
+    # seats is a list of (client id, name, chips), hole cards are filled in as they are dealt
+    return {
+        'table': table_id,
+        'hand': number,
+        'time': time.time(),
+        'seats': [[client_id, name, chips, []] for client_id, name, chips in seats],
+        'board': [],
+        'actions': [],
+        'pot': 0,
+        'winners': []
+    }
+
+
+def _pack_text(text):
+    data = text.encode('utf-8')[:255]
+    return TEXT.pack(len(data)) + data
+
+
+def _unpack_text(buffer, offset):
+    length = buffer[offset]
+    return str(buffer[offset + 1:offset + 1 + length], 'utf-8', 'replace'), offset + 1 + length
+
+
+def encode_hand(record):
+    parts = [HAND.pack(record['time'], record['hand'], record['pot'], len(record['seats']), len(record['board']),
+                       len(record['actions'])),
+             _pack_text(str(record['table']))]
+    for client_id, name, chips, hole in record['seats']:
+        hole = list(hole) + [255] * (2 - len(hole))
+        parts.append(SEAT.pack(client_id, chips, hole[0], hole[1]) + _pack_text(name))
+    parts.append(bytes(record['board']))
+    for when, client_id, kind, amount in record['actions']:
+        parts.append(ACTION.pack(when, client_id, ACTIONS.index(kind), amount))
+    parts.append(TEXT.pack(len(record['winners'])))
+    for client_id, amount in record['winners']:
+        parts.append(WINNER.pack(client_id, amount))
+    return b"".join(parts)
+
+
+def decode_hand(buffer):
+    started, number, pot, seat_count, board_count, action_count = HAND.unpack_from(buffer)
+    table_id, offset = _unpack_text(buffer, HAND.size)
+    seats = []
+    for _ in range(seat_count):
+        client_id, chips, card_a, card_b = SEAT.unpack_from(buffer, offset)
+        name, offset = _unpack_text(buffer, offset + SEAT.size)
+        seats.append([client_id, name, chips, [card for card in (card_a, card_b) if card != 255]])
+    board = list(buffer[offset:offset + board_count])
+    offset += board_count
+    actions = []
+    for _ in range(action_count):
+        when, client_id, kind, amount = ACTION.unpack_from(buffer, offset)
+        actions.append((when, client_id, ACTIONS[kind], amount))
+        offset += ACTION.size
+    winners = []
+    for _ in range(buffer[offset]):
+        winners.append(WINNER.unpack_from(buffer, offset + 1 + len(winners) * WINNER.size))
+    return {'table': table_id, 'hand': number, 'time': started, 'seats': seats, 'board': board,
+            'actions': actions, 'pot': pot, 'winners': winners}
+
+
+def segments(directory=LOG_DIR):
+    return sorted(glob.glob(os.path.join(directory, "hands-*.log")))
+
+
+def read_segment(path):
+    # Yields every complete hand in a segment, a record cut short by a crash ends the segment
+    with open(path, "rb") as log_file:
+        data = log_file.read()
+    magic, version = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} hand history")
+    offset = FILE_HEADER.size
+    while offset + RECORD.size <= len(data):
+        length = RECORD.unpack_from(data, offset)[0]
+        offset += RECORD.size
+        if offset + length > len(data):
+            return
+        yield decode_hand(memoryview(data)[offset:offset + length])
+        offset += length
+
+
+def read_hands(directory=LOG_DIR):
+    for path in segments(directory):
+        yield from read_segment(path)
+
+
+class HandLog:
+    # write() only queues the finished hand, encoding and file IO happen on the writer thread,
+    # which takes everything queued since its last write and appends it in one go
+
+    def __init__(self, directory=LOG_DIR, segment_bytes=SEGMENT_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment = max((int(os.path.basename(path)[6:-4]) for path in segments(directory)), default=0)
+        self.file = None
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.records.put(record)
+
+    def close(self):
+        # Writes out whatever is still queued, then stops the writer thread
+        self.records.put(None)
+        self.thread.join()
+
+    def open_segment(self):
+        if self.file is not None:
+            self.file.close()
+        self.segment += 1
+        self.file = open(os.path.join(self.directory, f"hands-{self.segment:06d}.log"), "ab")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            while True:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            data = b""
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    encoded = encode_hand(record)
+                except (struct.error, ValueError) as e:
+                    # One bad hand must not stop the log
+                    print(f"Could not record hand {record['hand']} at table {record['table']}: {e}")
+                    continue
+                data += RECORD.pack(len(encoded)) + encoded
+            if data:
+                if self.file is None or self.file.tell() + len(data) > self.segment_bytes:
+                    self.open_segment()
+                self.file.write(data)
+                self.file.flush()
+            if None in batch:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+
+def card_names(card_ids):
+    return " ".join(cards.CARDS[card].symbol() + cards.CARDS[card].suit for card in card_ids)
+
+
+if __name__ == "__main__":
+    for hand in read_hands(sys.argv[1] if len(sys.argv) > 1 else LOG_DIR):
+        names = {seat[0]: seat[1] for seat in hand['seats']}
+        print(f"Table {hand['table']} hand {hand['hand']} at {time.ctime(hand['time'])}, pot {hand['pot']}")
+        for client_id, name, chips, hole in hand['seats']:
+            print(f"  {name} ({chips} chips) {card_names(hole)}")
+        for when, client_id, kind, amount in hand['actions']:
+            print(f"  {when - hand['time']:7.3f}s {names.get(client_id, client_id)} {kind} {amount}")
+        print(f"  board {card_names(hand['board'])}")
+        for client_id, amount in hand['winners']:
+            print(f"  {names.get(client_id, client_id)} wins {amount}")
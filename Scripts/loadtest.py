@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+import protocol
+
+# Load generator: N bot players connect over real sockets, speak the same protocol as client.py and answer
+# every prompt on their own. Against a server that is already running (someone types /start on its console):
+#   python loadtest.py --bots 6 --duration 30
+# or let the harness start a local server and its tables itself:
+#   python loadtest.py --spawn --bots 12 --table-size 4 --duration 30
+# or have the bots queue for a stake and leave the seating to the server's matchmaker:
+#   python loadtest.py --spawn --bots 100 --queue 10 --duration 30
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+class Bot:
+
+    def __init__(self, name, table, strategy, rng, stats):
+        self.name = name
+        self.table = table
+        self.strategy = strategy
+        self.rng = rng
+        self.stats = stats
+        self.hands = 0
+        self.writer = None
+        self.sent_at = None
+
+    def send(self, text):
+        self.writer.write(protocol.encode(protocol.INPUT, protocol.SERVER_ID, text))
+        self.sent_at = time.perf_counter()
+        self.stats['actions'] += 1
+
+    def choose(self, options):
+        if self.strategy == "passive":
+            for option in ("check", "call", "fold"):
+                if option in options:
+                    return "/" + option
+        # Going all in busts bots too quickly to keep a table running, so only as a last resort
+        option = self.rng.choice([option for option in options if option != "all_in"] or options)
+        if option in ("raise", "bet"):
+            return f"/{option} {self.rng.randint(1, 3)}"
+        return "/" + option
+
+    def on_frame(self, msg_type, payload):
+        if msg_type == protocol.PROMPT:
+            self.send(self.choose(str(payload, 'utf-8').split("\n/")[1:]))
+        elif msg_type == protocol.SERVER_MSG:
+            text = str(payload, 'utf-8')
+            if text.startswith("Enter amount"):
+                self.send(str(self.rng.randint(1, 3)))
+            elif text.startswith("Winner is") or text.startswith("Split pot"):
+                self.hands += 1
+            elif text.startswith(f"{self.name} sat down at table "):
+                # Seated by the matchmaker
+                self.table = text.rsplit(" ", 1)[1]
+
+    async def connect(self, host, port, stake=None):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(protocol.encode(protocol.HELLO, protocol.SERVER_ID, self.name))
+        if stake is not None:
+            self.send(f"/queue {stake}")
+        return reader
+
+    async def run(self, reader, deadline):
+        decoder = protocol.FrameDecoder()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    data = await asyncio.wait_for(reader.read(protocol.READ_SIZE), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    # Closed by the server before the test was over
+                    self.stats['failures'] += 1
+                    break
+                if self.sent_at is not None:
+                    # The table waits on this seat, so the first read after an action is the server's answer to it
+                    self.stats['latencies'].append(time.perf_counter() - self.sent_at)
+                    self.sent_at = None
+                self.stats['bytes'] += len(data)
+                decoder.feed(data)
+                for msg_type, sender, payload in decoder.frames():
+                    self.on_frame(msg_type, payload)
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"{self.name}: {e}")
+            self.stats['failures'] += 1
+        finally:
+            self.writer.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def wait_for_server(host, port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+
+
+async def run_test(args):
+    stats = {'actions': 0, 'latencies': [], 'bytes': 0, 'failures': 0}
+    rng = random.Random(args.seed)
+    table_size = args.table_size or args.bots
+    # Bankrolls are saved by name, so every run brings new players with fresh stacks
+    run = os.urandom(3).hex()
+    server = None
+    if args.spawn:
+        server = subprocess.Popen([sys.executable, SERVER_PATH], cwd=os.path.dirname(SERVER_PATH),
+                                  stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+        await wait_for_server(args.host, args.port)
+
+    bots = []
+    readers = []
+    for number in range(args.bots):
+        bot = Bot(f"bot{number + 1}.{run}", number // table_size, args.strategy, random.Random(rng.getrandbits(32)),
+                  stats)
+        try:
+            readers.append(await bot.connect(args.host, args.port, args.queue))
+            bots.append(bot)
+        except OSError as e:
+            print(f"{bot.name}: {e}")
+            stats['failures'] += 1
+        if server and args.queue is None and (number + 1) % table_size == 0:
+            # Everyone still in the lobby goes to a new table
+            await asyncio.sleep(0.2)
+            server.stdin.write("/start\n")
+            server.stdin.flush()
+    if not server and args.queue is None:
+        print("Connected, waiting for /start on the server console")
+
+    started = time.monotonic()
+    await asyncio.gather(*(bot.run(reader, started + args.duration) for bot, reader in zip(bots, readers)))
+    elapsed = time.monotonic() - started
+
+    if server:
+        server.terminate()
+        server.wait()
+
+    # Every bot at a table sees the same result, so a table played as many hands as its busiest bot saw
+    tables = {}
+    for bot in bots:
+        tables[bot.table] = max(tables.get(bot.table, 0), bot.hands)
+    hands = sum(tables.values())
+    latencies = sorted(stats['latencies'])
+    print(f"bots                {len(bots)} at {len(tables)} table(s), {elapsed:.1f}s")
+    print(f"hands               {hands} ({hands / elapsed:.1f}/s)")
+    print(f"actions             {stats['actions']}, round trip p50 {percentile(latencies, 0.5) * 1000:.2f}ms "
+          f"p90 {percentile(latencies, 0.9) * 1000:.2f}ms p99 {percentile(latencies, 0.99) * 1000:.2f}ms "
+          f"max {percentile(latencies, 1.0) * 1000:.2f}ms")
+    print(f"bytes received      {stats['bytes']} ({stats['bytes'] / hands if hands else 0:.0f}/hand)")
+    print(f"connection failures {stats['failures']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a poker server with bot players")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7976)
+    parser.add_argument("--bots", type=int, default=6)
+    parser.add_argument("--table-size", type=int, default=0, help="bots per table, all at one table by default")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to play for")
+    parser.add_argument("--strategy", choices=("random", "passive"), default="random",
+                        help="random legal actions, or always check/call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queue", type=int, metavar="STAKE",
+                        help="queue every bot for this stake instead of seating them with /start")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start server.py and its tables instead of using a running server")
+    asyncio.run(run_test(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import heapq
+from itertools import count
+
+# Who is waiting for a seat and which tables have one, by stake. Both are heaps, so joining the queue, seating
+# the next player and finding the table to seat them at are O(log n) however many are waiting. Nothing is ever
+# taken out of the middle of a heap: leaving the queue or a change in a table's seat count leaves the old entry
+# behind, and a stale entry is thrown away when it reaches the top. A heap that is mostly stale entries is
+# rebuilt from its live ones, so players going back and forth cannot grow it without bound
+
+TABLE_SIZE = 6
+COMPACT_SIZE = 64  # entries a heap holds before it is checked for stale ones
+
+
+class Matchmaker:
+
+    def __init__(self, table_size=TABLE_SIZE):
+        self.table_size = table_size
+        self.waiting = {}  # stake -> heap of (time joined, order, player)
+        self.queued = {}  # player -> (stake, order) of their live entry
+        self.counts = {}  # stake -> players waiting
+        self.open = {}  # stake -> heap of (-players seated, order, table id), the fullest table on top
+        self.seated = {}  # table id -> (stake, players seated)
+        self.free = {}  # stake -> open seats over all its tables
+        self.order = count()
+
+    def join(self, player, stake, joined):
+        entry = self.queued.get(player)
+        if entry is not None and entry[0] == stake:
+            # Already waiting for this stake, they keep their place
+            return
+        self.leave(player)
+        order = next(self.order)
+        self.queued[player] = (stake, order)
+        self.counts[stake] = self.counts.get(stake, 0) + 1
+        heap = self.waiting.setdefault(stake, [])
+        heapq.heappush(heap, (joined, order, player))
+        if len(heap) > COMPACT_SIZE and len(heap) > 2 * self.counts[stake]:
+            heap[:] = [entry for entry in heap if self.queued.get(entry[2]) == (stake, entry[1])]
+            heapq.heapify(heap)
+
+    def leave(self, player):
+        # True if the player was waiting
+        entry = self.queued.pop(player, None)
+        if entry is None:
+            return False
+        self.counts[entry[0]] -= 1
+        return True
+
+    def waiting_count(self, stake):
+        return self.counts.get(stake, 0)
+
+    def pop_player(self, stake):
+        # The player who has waited longest for this stake, None if nobody is waiting
+        heap = self.waiting.get(stake, [])
+        while heap:
+            joined, order, player = heapq.heappop(heap)
+            if self.queued.get(player) == (stake, order):
+                self.leave(player)
+                return player
+        return None
+
+    def update_table(self, table_id, stake, seated):
+        # Every change in a table's seat count is reported here
+        old_stake, old_seated = self.seated.get(table_id, (stake, self.table_size))
+        self.free[old_stake] = self.free.get(old_stake, 0) - max(0, self.table_size - old_seated)
+        self.seated[table_id] = (stake, seated)
+        self.free[stake] = self.free.get(stake, 0) + max(0, self.table_size - seated)
+        if seated < self.table_size:
+            heap = self.open.setdefault(stake, [])
+            heapq.heappush(heap, (-seated, next(self.order), table_id))
+            if len(heap) > COMPACT_SIZE and len(heap) > 2 * len(self.seated):
+                # A table that went back to an earlier seat count has several live entries, one is enough
+                live = {}
+                for entry in heap:
+                    if self.seated.get(entry[2]) == (stake, -entry[0]):
+                        live.setdefault(entry[2], entry)
+                heap[:] = live.values()
+                heapq.heapify(heap)
+
+    def remove_table(self, table_id):
+        # The table no longer takes players
+        stake, seated = self.seated.pop(table_id, (None, self.table_size))
+        if stake is not None:
+            self.free[stake] -= max(0, self.table_size - seated)
+
+    def free_seats(self, stake):
+        return self.free.get(stake, 0)
+
+    def fullest_open(self, stake):
+        # The table with the most players that still has a free seat, left on the heap
+        heap = self.open.get(stake, [])
+        while heap:
+            negative, order, table_id = heap[0]
+            if self.seated.get(table_id) == (stake, -negative) and -negative < self.table_size:
+                return table_id
+            heapq.heappop(heap)
+        return None
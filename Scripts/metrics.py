@@ -0,0 +1,121 @@
+import asyncio
+import bisect
+import time
+
+# Counters and latency histograms kept in plain dicts, cheap enough to leave on: recording is a dict lookup
+# and an add. Read them with /stats on the server console, or scrape the text endpoint started by serve(),
+# which answers any HTTP GET with the Prometheus text format
+
+PREFIX = "poker_"
+
+# Histogram bucket upper bounds in seconds, anything slower lands in a final +Inf bucket
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Name of the label each labelled metric is split by
+LABEL_NAMES = {
+    "frames_in": "title",
+    "frames_out": "title",
+    "bytes_in": "title",
+    "bytes_out": "title",
+    "street_seconds": "street"
+}
+
+counters = {}  # (name, label) -> value
+histograms = {}  # (name, label) -> [bucket counts, sum of observations]
+gauges = {}  # name -> function returning the current value
+started = time.time()
+
+
+def inc(name, label="", amount=1):
+    key = (name, label)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, label=""):
+    histogram = histograms.get((name, label))
+    if histogram is None:
+        histogram = histograms[(name, label)] = [[0] * (len(BUCKETS) + 1), 0.0]
+    histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+    histogram[1] += seconds
+
+
+def gauge(name, function):
+    gauges[name] = function
+
+
+def quantile(buckets, fraction):
+    # Upper bound of the bucket holding the given fraction of observations
+    target = fraction * sum(buckets)
+    seen = 0
+    for bound, count in zip(BUCKETS + (float("inf"),), buckets):
+        seen += count
+        if seen >= target:
+            return bound
+    return float("inf")
+
+
+def _name(name, label):
+    return f"{name}[{label}]" if label else name
+
+
+def summary():
+    lines = [f"Up {time.time() - started:.0f}s"]
+    for name, function in sorted(gauges.items()):
+        lines.append(f"{name:32} {function()}")
+    for (name, label), value in sorted(counters.items()):
+        lines.append(f"{_name(name, label):32} {value}")
+    for (name, label), (buckets, total) in sorted(histograms.items()):
+        count = sum(buckets)
+        lines.append(f"{_name(name, label):32} {count} observed, mean {total / count * 1000:.2f}ms, "
+                     f"p50 <= {quantile(buckets, 0.5) * 1000:g}ms, p99 <= {quantile(buckets, 0.99) * 1000:g}ms")
+    return "\n".join(lines)
+
+
+def _labels(name, label, extra=""):
+    labels = [f'{LABEL_NAMES.get(name, "label")}="{label}"'] if label else []
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def exposition():
+    lines = [f"{PREFIX}uptime_seconds {time.time() - started:.3f}"]
+    for name, function in sorted(gauges.items()):
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        lines.append(f"{PREFIX}{name} {function()}")
+    typed = set()
+    for (name, label), value in sorted(counters.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+        lines.append(f"{PREFIX}{name}_total{_labels(name, label)} {value}")
+    for (name, label), (buckets, total) in sorted(histograms.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), buckets):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{PREFIX}{name}_bucket{_labels(name, label, le)} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{_labels(name, label)} {total}")
+        lines.append(f"{PREFIX}{name}_count{_labels(name, label)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+async def handle_scrape(reader, writer):
+    try:
+        # Whatever was asked for, the answer is the metrics
+        await reader.readline()
+        body = exposition().encode('utf-8')
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    return await asyncio.start_server(handle_scrape, host, port)
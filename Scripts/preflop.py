@@ -0,0 +1,139 @@
+import mmap
+import os
+import random
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import cards
+import equity
+
+# Preflop equity tables for the 169 canonical starting hands, built once with
+#   python preflop.py [samples]
+# and memory-mapped by the server and client. The file is a header followed by float32 tables:
+#   heads_up[169][169]      equity of hand i against hand j
+#   against[169][opponents] equity of hand i against 1..opponents random hands
+
+HANDS = 169
+MAX_OPPONENTS = 9
+MAGIC = b"PFEQ"
+VERSION = 1
+HEADER = struct.Struct("<4sHHH")
+EQUITY = struct.Struct("<f")
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preflop.bin")
+
+
+def hand_index(card_a, card_b):
+    # Index into the 13x13 starting hand grid: pairs on the diagonal, suited above it, offsuit below it
+    row = 14 - max(cards.CARD_VALUES[card_a], cards.CARD_VALUES[card_b])
+    col = 14 - min(cards.CARD_VALUES[card_a], cards.CARD_VALUES[card_b])
+    if card_a & 3 == card_b & 3:
+        return row * 13 + col
+    return col * 13 + row
+
+
+def hand_label(index):
+    row, col = divmod(index, 13)
+    high = cards.SYMBOLS.get(14 - min(row, col), str(14 - min(row, col)))
+    low = cards.SYMBOLS.get(14 - max(row, col), str(14 - max(row, col)))
+    if row == col:
+        return high + low
+    return high + low + ("s" if row < col else "o")
+
+
+COMBOS = [[] for _ in range(HANDS)]
+for _card_a in range(52):
+    for _card_b in range(_card_a + 1, 52):
+        COMBOS[hand_index(_card_a, _card_b)].append((_card_a, _card_b))
+
+
+class PreflopTable:
+
+    def __init__(self, path=TABLE_PATH):
+        with open(path, "rb") as table_file:
+            self.data = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, hands, self.max_opponents = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION or hands != HANDS:
+            self.data.close()
+            raise ValueError(f"{path} is not a version {VERSION} preflop table")
+        self.against_offset = HEADER.size + HANDS * HANDS * EQUITY.size
+
+    def heads_up(self, hand, villain):
+        return EQUITY.unpack_from(self.data, HEADER.size + (hand * HANDS + villain) * EQUITY.size)[0]
+
+    def against(self, hand, opponents):
+        opponents = min(max(opponents, 1), self.max_opponents)
+        offset = self.against_offset + (hand * self.max_opponents + opponents - 1) * EQUITY.size
+        return EQUITY.unpack_from(self.data, offset)[0]
+
+    def equity(self, hole, opponents):
+        # Equity of the two dealt cards against a number of random hands
+        return self.against(hand_index(*hole), opponents)
+
+    def close(self):
+        self.data.close()
+
+
+def load(path=TABLE_PATH):
+    # Returns None when the table has not been built
+    try:
+        return PreflopTable(path)
+    except (OSError, ValueError):
+        return None
+
+
+def heads_up_row(hand, samples, seed):
+    # Equity of hand against every hand from itself up, the rest of the matrix follows from symmetry
+    rng = random.Random(seed)
+    row = []
+    for villain in range(hand, HANDS):
+        equity_total = 0.0
+        done = 0
+        while done < samples:
+            hero_cards = rng.choice(COMBOS[hand])
+            villain_cards = rng.choice(COMBOS[villain])
+            dead = set(hero_cards + villain_cards)
+            if len(dead) < 4:
+                continue
+            board = [card for card in rng.sample(range(52), 9) if card not in dead][:5]
+            hero = cards.evaluate(list(hero_cards) + board)
+            other = cards.evaluate(list(villain_cards) + board)
+            equity_total += 1.0 if hero > other else 0.5 if hero == other else 0.0
+            done += 1
+        row.append(equity_total / samples)
+    return row
+
+
+def against_row(hand, samples, seed):
+    rng = random.Random(seed)
+    row = []
+    for opponents in range(1, MAX_OPPONENTS + 1):
+        hole = list(rng.choice(COMBOS[hand]))
+        row.append(equity.simulate(hole, [], opponents, samples, rng.getrandbits(32))[2] / samples)
+    return row
+
+
+def build(samples, path=TABLE_PATH, seed=0):
+    heads_up = [[0.0] * HANDS for _ in range(HANDS)]
+    with ProcessPoolExecutor() as executor:
+        up_rows = executor.map(heads_up_row, range(HANDS), [samples] * HANDS, range(seed, seed + HANDS))
+        against_rows = executor.map(against_row, range(HANDS), [samples] * HANDS,
+                                    range(seed + HANDS, seed + 2 * HANDS))
+        for hand, row in enumerate(up_rows):
+            for villain, value in enumerate(row, hand):
+                heads_up[hand][villain] = value
+                if villain != hand:
+                    heads_up[villain][hand] = 1.0 - value
+            print(f"Heads up: {hand_label(hand)} done")
+        against = list(against_rows)
+
+    with open(path + ".tmp", "wb") as table_file:
+        table_file.write(HEADER.pack(MAGIC, VERSION, HANDS, MAX_OPPONENTS))
+        for row in heads_up + against:
+            table_file.write(struct.pack(f"<{len(row)}f", *row))
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    build(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,221 @@
+import struct
+
+# Wire protocol shared by server.py and client.py
+# Every frame is an 8 byte header followed by the payload:
+#   version (1 byte), message type (1 byte), sender id (2 bytes), payload length (4 bytes), network byte order
+# Text payloads are UTF-8, card payloads are one byte per card id (see cards.py)
+
+VERSION = 1
+HEADER = struct.Struct("!BBHI")
+
+# Largest payload a peer may announce, anything bigger is treated as a broken stream
+MAX_PAYLOAD = 1 << 20
+READ_SIZE = 1 << 16
+
+# Sender id of messages that come from the server itself, players get ids from 1 up
+SERVER_ID = 0
+MAX_ID = 0xFFFF
+
+# Server -> client
+TEXT = 1
+SERVER_MSG = 2
+DEAL = 3
+COMMUNITY = 4
+ALERT = 5
+PROMPT = 6
+PLAYER = 7  # introduces a sender id, the payload is that player's name
+BATCH = 8  # several complete frames back to back, sent as one so a game step costs one write
+SESSION = 9  # the token to send in RESUME after losing the connection, empty when there is nothing to resume
+SNAPSHOT = 10  # everything needed to pick up a hand after reconnecting, see encode_snapshot
+
+# Client -> server
+HELLO = 32  # first frame on a connection, the payload is the nickname
+INPUT = 33  # one line typed by the player
+RESUME = 34  # instead of HELLO, takes back the seat of the session whose token is the payload
+
+TITLES = {
+    TEXT: "TEXT",
+    SERVER_MSG: "SERVER-MSG",
+    DEAL: "DEAL",
+    COMMUNITY: "COMMUNITY",
+    ALERT: "ALERT",
+    PROMPT: "PROMPT",
+    PLAYER: "PLAYER",
+    BATCH: "BATCH",
+    SESSION: "SESSION",
+    SNAPSHOT: "SNAPSHOT",
+    HELLO: "HELLO",
+    INPUT: "INPUT",
+    RESUME: "RESUME"
+}
+
+CARD_TYPES = {DEAL, COMMUNITY}
+
+# Snapshot payload: SNAPSHOT_HEADER, the table id (1 byte length + UTF-8), SNAPSHOT_SEAT for every seat,
+# then the board and your hole cards as one byte per card id. Names come from the PLAYER frames sent before it
+SNAPSHOT_HEADER = struct.Struct("!iiHIBBB")  # pot, current bet, acting id, ms left to act, seats, board, hole
+SNAPSHOT_SEAT = struct.Struct("!HiiB")  # id, chips, chips in this betting round, flags
+IN_HAND = 1
+DISCONNECTED = 2
+BOT = 4
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(msg_type, sender, data):
+    if msg_type in CARD_TYPES:
+        payload = bytes(data)
+    elif msg_type == SNAPSHOT:
+        payload = encode_snapshot(data)
+    else:
+        payload = data.encode('utf-8')
+    return HEADER.pack(VERSION, msg_type, sender, len(payload)) + payload
+
+
+def encode_batch(frames):
+    # frames is a list of encoded frames, a single frame is sent as it is. More than MAX_PAYLOAD is split over
+    # as many batches as it takes, back to back, so a peer's decoder never sees a batch it has to refuse
+    if len(frames) == 1:
+        return frames[0]
+    payload = b"".join(frames)
+    if len(payload) <= MAX_PAYLOAD:
+        return HEADER.pack(VERSION, BATCH, SERVER_ID, len(payload)) + payload
+    parts = []
+    start = size = 0
+    for index, frame in enumerate(frames):
+        if size + len(frame) > MAX_PAYLOAD and index > start:
+            parts.append(encode_batch(frames[start:index]))
+            start = index
+            size = 0
+        size += len(frame)
+    parts.append(encode_batch(frames[start:]))
+    return b"".join(parts)
+
+
+def decode_header(buffer, offset=0):
+    # Returns (message type, sender id, payload length)
+    version, msg_type, sender, length = HEADER.unpack_from(buffer, offset)
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame of {length} bytes is too large")
+    return msg_type, sender, length
+
+
+def split_frames(buffer):
+    # Yields (message type, sender id, payload) for the frames packed in a BATCH payload, a batch queued as one
+    # frame of a bigger batch (see server.introduce) is unpacked too
+    offset = 0
+    while offset < len(buffer):
+        msg_type, sender, length = decode_header(buffer, offset)
+        offset += HEADER.size + length
+        if offset > len(buffer):
+            raise ProtocolError("Truncated frame in batch")
+        if msg_type == BATCH:
+            yield from split_frames(buffer[offset - length:offset])
+        else:
+            yield msg_type, sender, buffer[offset - length:offset]
+
+
+def encode_snapshot(snapshot):
+    table_id = str(snapshot['table']).encode('utf-8')[:255]
+    parts = [SNAPSHOT_HEADER.pack(snapshot['pot'], snapshot['current_bet'], snapshot['acting'],
+                                  snapshot['time_left_ms'], len(snapshot['seats']), len(snapshot['board']),
+                                  len(snapshot['hole'])),
+             bytes([len(table_id)]), table_id]
+    for seat in snapshot['seats']:
+        parts.append(SNAPSHOT_SEAT.pack(*seat))
+    parts.append(bytes(snapshot['board']))
+    parts.append(bytes(snapshot['hole']))
+    return b"".join(parts)
+
+
+def decode_snapshot(payload):
+    pot, current_bet, acting, time_left_ms, seat_count, board_count, hole_count = SNAPSHOT_HEADER.unpack_from(payload)
+    offset = SNAPSHOT_HEADER.size
+    table_id = str(payload[offset + 1:offset + 1 + payload[offset]], 'utf-8')
+    offset += 1 + payload[offset]
+    seats = []
+    for _ in range(seat_count):
+        seats.append(SNAPSHOT_SEAT.unpack_from(payload, offset))
+        offset += SNAPSHOT_SEAT.size
+    board = list(payload[offset:offset + board_count])
+    hole = list(payload[offset + board_count:offset + board_count + hole_count])
+    return {'table': table_id, 'pot': pot, 'current_bet': current_bet, 'acting': acting,
+            'time_left_ms': time_left_ms, 'seats': seats, 'board': board, 'hole': hole}
+
+
+def decode_payload(msg_type, payload):
+    if msg_type in CARD_TYPES:
+        return list(payload)
+    if msg_type == SNAPSHOT:
+        return decode_snapshot(payload)
+    return str(payload, 'utf-8')
+
+
+class FrameDecoder:
+    # Incremental decoder for a stream of frames: reads land straight in one reusable bytearray
+    # (recv_into / BufferedProtocol.get_buffer) and every complete frame in it is cut out as a memoryview,
+    # so TCP splitting or coalescing frames does not matter and nothing is copied per frame
+
+    def __init__(self, size=READ_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte that has not been decoded yet
+        self.end = 0  # one past the last byte received
+        self.needed = HEADER.size  # bytes the next frame takes up, once its header has arrived
+
+    def get_buffer(self):
+        # Free space at the end of the buffer to read into, payloads from frames() are invalid after this
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < READ_SIZE // 4 or len(self.buffer) - self.start < self.needed:
+            # Little room left at the end: move the partial frame to the front, into a bigger buffer if it
+            # does not fit (payloads handed out earlier keep the old buffer alive until they are dropped)
+            pending = self.end - self.start
+            size = max(self.needed, pending) + READ_SIZE
+            if size > len(self.buffer):
+                buffer = bytearray(size)
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def advance(self, count):
+        # count bytes were written into the buffer returned by get_buffer
+        self.end += count
+
+    def feed(self, data):
+        while data:
+            space = self.get_buffer()
+            count = min(len(space), len(data))
+            space[:count] = data[:count]
+            self.advance(count)
+            data = data[count:]
+
+    def recv(self, sock):
+        # One recv_into on a blocking socket, returns the byte count (0 once the peer has closed)
+        count = sock.recv_into(self.get_buffer())
+        self.advance(count)
+        return count
+
+    def frames(self):
+        # Yields (message type, sender id, payload) for every complete frame received so far, batches are unpacked
+        while self.end - self.start >= HEADER.size:
+            msg_type, sender, length = decode_header(self.buffer, self.start)
+            self.needed = HEADER.size + length
+            frame_end = self.start + self.needed
+            if frame_end > self.end:
+                return
+            payload = self.view[self.start + HEADER.size:frame_end]
+            self.start = frame_end
+            self.needed = HEADER.size
+            if msg_type == BATCH:
+                yield from split_frames(payload)
+            else:
+                yield msg_type, sender, payload
@@ -1,482 +1,1456 @@
+import argparse
+import asyncio
+import os
+import secrets
+import signal
 import socket
 import sys
 import threading
-import pickle
+import time
+from collections import deque, namedtuple
+from itertools import count, islice
 
+import bots
 import cards
-
-from itertools import combinations
+import equity
+import gateway
+import history
+import matchmaker
+import metrics
+import preflop
+import protocol
+import store
+import timing
 
 host = ''  # IPv4 Address
 port = 7976  # port
+metrics_port = 9108  # Prometheus-style text endpoint, only served on localhost
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # socket initialization
-server.bind((host, port))  # binding host and port to socket
-server.listen()
-
+# Everything below runs on one asyncio event loop: clients are keyed by their Session
 clients = {}
 
-game_started = False
-game_state = {
-    "pot": 0,
-    "current_bet": 0,
-    "players": [],
-    "rounds": 0,
-    "end_count": 0
+# Nicknames in use, taken as soon as a login starts so two players logging in at once never get the same one.
+# Behind a gateway the gateway keeps them for every worker, see reserve_name
+names = set()
+name_requests = {}
+request_numbers = count()
+NAME_LIMIT = 32  # characters
+
+# Every registered session by token, seated players whose connection dropped stay here until RECONNECT_GRACE
+# runs out, so RESUME can hand them their seat back
+sessions = {}
+RECONNECT_GRACE = 60
+TURN_TIMEOUT = 30  # seconds a player has to act, a reconnect does not restart the clock
+TIME_BANK = 30  # extra seconds each player can spread over their turns once TURN_TIMEOUT runs out
+TIME_BANK_REFILL = 2  # seconds added back to the bank every hand, up to TIME_BANK
+
+# Every turn clock, time bank and reconnect grace period on the server
+timers = timing.TimingWheel()
+
+# Every table hosted by this server, by table id
+tables = {}
+
+# Players queue for a stake with /queue and are seated automatically. Tables made on the console with /start or
+# /bots have no stake and play for BLINDS, players /join them while they have room and they close once empty
+STAKES = (2, 10, 50)  # big blinds to choose from, the small blind is half
+BLINDS = (1, 2)
+MIN_PLAYERS = 2
+lobby_queue = matchmaker.Matchmaker()
+matchmake_pending = False
+
+last_client_id = protocol.SERVER_ID
+
+# Set when this process is one of several workers behind gateway.py: client ids are split between the workers,
+# lobby frames are relayed to the others over the control socket and remote_players holds their players' names
+worker_index = 0
+worker_count = 1
+control = None
+remote_players = {}
+
+# Lines typed into the server console, fed in by watch_console (or its thread) and read by command
+admin_lines = asyncio.Queue()
+console_pending = b""  # the start of a console line whose newline has not arrived yet
+
+# Finished hands are appended here, opened by main
+hand_log = None
+
+# Chip counts by nickname, kept across reconnects and restarts, opened by main
+player_store = None
+STARTING_CHIPS = 100
+
+# Memory-mapped preflop equity table, None until preflop.py has been run
+preflop_table = preflop.load()
+
+# Bot decisions being worked out, the event loop only keeps weak references to its tasks
+bot_tasks = set()
+
+ACTION_QUEUE_SIZE = 8
+
+# A player's input during a hand, parsed once when it arrives: kind is a betting option, "amount" for a bare
+# number, "unknown" for anything else or "leave" when the seat empties mid-hand
+Action = namedtuple("Action", ["kind", "amount"])
+GAME_ACTIONS = ("call", "raise", "fold", "all_in", "check", "bet")
+ODDS_DEADLINE_MS = 300
+
+ADMIN_USAGE = {
+    "/bots": "/bots <table> [count]",
+    "/add_chips": "/add_chips [<name> <chips>], asks for the name and a whole number of chips if not given"
 }
 
-msg_event = threading.Event()
 
-HEADER_LENGTH = 10
+class Session:
+    # Stands in for the transport everywhere a client is used as a key (clients, tables, the outbox). When a
+    # player reconnects the new transport is attached to their old Session, so a hand in progress never
+    # notices. transport is None while disconnected, which makes is_closing() true and drops their frames
 
+    def __init__(self, transport):
+        self.transport = transport
+        # The first byte names the worker that owns the session, so the gateway can send a RESUME back to it
+        self.token = f"{worker_index:02x}" + secrets.token_hex(15)
+        self.expiry = None
 
-def broadcast_targeted(data, client, sender, title):
-    data = {'title': title, 'data': data}
+    def write(self, data):
+        self.transport.write(data)
 
-    msg = pickle.dumps(data)
-    msg = bytes(f"{len(msg):<{HEADER_LENGTH}}", 'utf-8') + msg
+    def is_closing(self):
+        return self.transport is None or self.transport.is_closing()
 
-    if sender is None:
-        sender_info = pickle.dumps("Server")
-        sender_info = bytes(f"{len(sender_info):<{HEADER_LENGTH}}", 'utf-8') + sender_info
-    else:
-        sender_info = pickle.dumps(clients[sender]['name'])
-        sender_info = bytes(f"{len(sender_info):<{HEADER_LENGTH}}", 'utf-8') + sender_info
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
 
-    client.send(sender_info + msg)
+    def abort(self):
+        if self.transport is not None:
+            self.transport.abort()
 
+    def get_extra_info(self, name):
+        return None if self.transport is None else self.transport.get_extra_info(name)
 
-def broadcast(message, sender, title):
-    # currently only works with strings
-    for client in clients:
-        if client is not sender:
-            broadcast_targeted(message, client, sender, title)
 
+# Frames waiting to go out, by session. Everything queued for a client during one game step is flushed
+# together as a single BATCH frame once the step yields back to the event loop. A client whose socket cannot
+# keep up (its transport paused writing) keeps collecting frames here, up to OUTBOX_LIMIT
+outbox = {}
+paused = set()
+flush_pending = False
 
-def remove_client(client):
-    print(f'{clients[client]["name"]} disconnected!')
-    broadcast(f'{clients[client]["name"]} was removed!', client, 'TEXT')
-    del clients[client]
+OUTBOX_LIMIT = 256  # frames a client may have waiting
+SLOW_CLIENT_POLICY = "disconnect"  # what happens past OUTBOX_LIMIT: "disconnect" the client or "drop" the frames
+WRITE_BUFFER_HIGH = 1 << 16  # bytes the transport buffers before it pauses writing
 
+SPECTATOR_BACKLOG = 512  # public frames a table keeps for its spectators
+SPECTATOR_INTERVAL = 0.05  # seconds between writes to spectators, everything in between goes as one batch
 
-def process_message(client):
-    try:
-        # Receive our "header" containing message length, it's size is defined and constant
-        message_header = client.recv(HEADER_LENGTH)
-        # If we received no data, client gracefully closed a connection, for example using socket.close() or
-        # socket.shutdown(socket.SHUT_RDWR)
-        if not len(message_header):
-            return True
-
-        # Convert header to int value
-        message_length = int(message_header.decode('utf-8').strip())
 
-        # Return an object of message header and message data
-        return {'header': message_header.decode('utf-8'), 'data': client.recv(message_length).decode('utf-8')}
+def flush_outbox():
+    global flush_pending
+    flush_pending = False
+    for client in list(outbox):
+        if client.is_closing():
+            del outbox[client]
+        elif client not in paused:
+            client.write(protocol.encode_batch(outbox.pop(client)))
 
-    except Exception as e:
-        print(f'Error in processing message: {e}')
-        return False
 
+def schedule_flush():
+    global flush_pending
+    if not flush_pending:
+        flush_pending = True
+        asyncio.get_running_loop().call_soon(flush_outbox)
 
-def handle(client):
-    while True:
-        try:
-            # Receive message
-            message = process_message(client)
-            if message is False:
-                remove_client(client)
-                break
 
-            print(f'Received message from {clients[client]["name"]}: {message["data"]}')
+def queue_frame(client, frame):
+    # Never blocks: a slow client only ever costs its own queue, the table carries on either way
+    if client.is_closing():
+        return
+    frames = outbox.setdefault(client, [])
+    if len(frames) >= OUTBOX_LIMIT:
+        if SLOW_CLIENT_POLICY == "disconnect":
+            print(f"Disconnecting {client.get_extra_info('peername')}, {len(frames)} frames behind")
+            del outbox[client]
+            client.abort()
+        metrics.inc("slow_clients")
+        return
+    frames.append(frame)
+    schedule_flush()
+    # The type byte of the header says what kind of frame this is
+    title = protocol.TITLES.get(frame[1], "")
+    metrics.inc("frames_out", title)
+    metrics.inc("bytes_out", title, len(frame))
 
-            # store past 1000 client messages
-            if len(clients[client]["msgs"]) > 1000:
-                clients[client]["msgs"].pop(0)
 
-            clients[client]["msgs"].append(message['data'])
+def broadcast_targeted(data, client, sender, title):
+    sender_id = protocol.SERVER_ID if sender is None else clients[sender]['id']
+    queue_frame(client, protocol.encode(title, sender_id, data))
 
-            if not game_started:
-                # Chat room
-                if message['data'][0] == "/":
-                    # Chat room commands
-                    continue
-                else:
-                    broadcast(message["data"], client, 'TEXT')
-            else:
-                if clients[client]['options'] and not msg_event.is_set():
-                    msg_event.set()
 
-        except Exception as e:
-            print(f'Error in handling message: {e}')
-            remove_client(client)
-            break
+def broadcast(message, sender, title, targets=None):
+    # Encoded once, every target queues the same bytes
+    frame = protocol.encode(title, protocol.SERVER_ID if sender is None else clients[sender]['id'], message)
+    for client in clients if targets is None else targets:
+        if client is not sender:
+            queue_frame(client, frame)
+    return frame
 
 
-def receive():
+def next_client_id():
+    # Ids go on the wire as the 2 byte sender of each frame, skip any that are still in use
+    global last_client_id
+    used = {clients[client]['id'] for client in clients}
     while True:
-        try:
-            client, address = server.accept()
-            print("Connected with {}".format(str(address)))
+        last_client_id = last_client_id % protocol.MAX_ID + 1
+        if (last_client_id - 1) % worker_count == worker_index and last_client_id not in used:
+            return last_client_id
 
-            # Client should send name right away, receive it
-            username = process_message(client)
-            if username is False:
-                remove_client(client)
-                continue
-            for c in clients:
-                if clients[c]["name"] == username['data']:
-                    username['data'] = username['data'] + "'"
-
-            # Make new player/client
-            user = {
-                'name': username['data'],
-                'chips': 100,
-                'hand': [],
-                'role': "N",
-                'options': [],
-                "msgs": [],
-                "in_for": 0
-            }
-            clients[client] = user
-            print('Accepted new connection from {}:{}, username: {}'.format(*address,
-                                                                            user['name']))
-
-            # Send "..." has joined the server
-            broadcast("{} joined!".format(user['name']), client, 'TEXT')
-            thread = threading.Thread(target=handle, args=(client,))  # make new thread for each client
-            thread.start()
-        except Exception as e:
-            print("Error running the server!")
-            e = sys.exc_info()[0]
-            print("Error: %s" % e)
-            break
 
+def relay(frame):
+    # Lobby frames reach the lobbies of the other workers too, as long as they fit in one control packet
+    if control is not None and len(frame) - protocol.HEADER.size <= gateway.MAX_RELAYED:
+        control.send(gateway.RELAY + frame)
 
-def add_to_pot(client, amount):
-    clients[client]['chips'] -= amount
-    clients[client]["in_for"] += amount
-    game_state["pot"] += amount
 
+def report_load():
+    if control is not None:
+        control.send(gateway.LOAD + str(len(clients)).encode())
 
-def cmd_call(client):
-    add_to_pot(client, game_state["current_bet"]-clients[client]["in_for"])
-    game_state["end_count"] += 1
-    broadcast(f"{clients[client]['name']} calls", None, "SERVER-MSG")
 
+def relayed(frame):
+    # A lobby frame from another worker
+    msg_type, sender, length = protocol.decode_header(frame)
+    if msg_type == protocol.PLAYER:
+        remote_players[sender] = str(frame[protocol.HEADER.size:], 'utf-8')
+        targets = [client for client in clients if clients[client]['watching'] is None]
+    else:
+        targets = lobby()
+    for client in targets:
+        queue_frame(client, frame)
+
+
+def new_user(name, chips, bot=False):
+    return {
+        'name': name,
+        'chips': chips,
+        'hand': [],
+        'hand_state': None,
+        'role': "N",
+        'options': [],
+        "in_for": 0,
+        "table": None,
+        "watching": None,
+        "bot": bot,
+        "time_bank": TIME_BANK,
+        "id": next_client_id()
+    }
 
-def cmd_raise(client):
-    game_state["end_count"] = 1
-    while True:
-        msg_event.clear()
-        broadcast_targeted("Enter amount to raise by (the call is already included)('#'):", client, None, "SERVER-MSG")
-        msg_event.wait()
-        raise_amount = clients[client]['msgs'][-1]
-        try:
-            raise_amount = int(raise_amount)
-            total_amount = raise_amount + game_state["current_bet"]-clients[client]["in_for"]
-        except ValueError:
-            broadcast_targeted("Please enter a number", client, None, "SERVER-MSG")
-            continue
-        if clients[client]["chips"] < total_amount:
-            broadcast_targeted("Insufficient chips", client, None, "SERVER-MSG")
-            continue
-        else:
-            game_state["current_bet"] = total_amount + clients[client]["in_for"]
-            add_to_pot(client, total_amount)
-            break
-    broadcast(f"{clients[client]['name']} raises by {raise_amount}", None, "SERVER-MSG")
-    return
 
+def add_bot(table):
+    # A bot is a Session without a transport: frames to it are dropped, it only ever sees its own turns
+    bot = Session(None)
+    clients[bot] = new_user("", STARTING_CHIPS, bot=True)
+    clients[bot]['name'] = f"Bot {clients[bot]['id']}"
+    broadcast(clients[bot]['name'], bot, protocol.PLAYER, [c for c in clients if clients[c]['watching'] is None])
+    table.sit(bot)
+    return bot
 
-def cmd_fold(client):
-    game_state["players"].remove(client)
-    broadcast(f"{clients[client]['name']} folds", None, "SERVER-MSG")
 
+def lobby():
+    # Clients that are neither sitting at a table nor watching one
+    return [client for client in clients if clients[client]['table'] is None and clients[client]['watching'] is None]
 
-def cmd_all_in(client):
-    broadcast(f"{clients[client]['name']} is all in ({clients[client]['chips']} chips)", None, "SERVER-MSG")
-    if clients[client]["chips"] > game_state["current_bet"]:
-        game_state["current_bet"] = clients[client]["chips"] + clients[client]["in_for"]
-        game_state["end_count"] = 1
-    elif clients[client]["chips"] <= game_state["current_bet"]:
-        game_state["end_count"] += 1
-    add_to_pot(client, clients[client]["chips"])
 
+def introduce(client):
+    # Tells client who everyone is, as one frame however many players there are
+    frames = [protocol.encode(protocol.PLAYER, clients[c]['id'], clients[c]['name']) for c in clients]
+    frames += [protocol.encode(protocol.PLAYER, player_id, name) for player_id, name in remote_players.items()]
+    if frames:
+        queue_frame(client, protocol.encode_batch(frames))
 
-def cmd_check(client):
-    game_state["end_count"] += 1
-    broadcast(f"{clients[client]['name']} checks", None, "SERVER-MSG")
 
+async def reserve_name(name):
+    # The nickname a new player gets: theirs, with a ' added for as long as it is taken
+    if control is None:
+        while name in names:
+            name += "'"
+        names.add(name)
+        return name
+    request = next(request_numbers)
+    future = name_requests[request] = asyncio.get_running_loop().create_future()
+    control.send(gateway.NAME + f"{request} {name}".encode('utf-8'))
+    return await future
 
-def cmd_bet(client):
-    game_state["end_count"] = 1
-    while True:
-        msg_event.clear()
-        broadcast_targeted("Enter amount to bet('#'):", client, None, "SERVER-MSG")
-        msg_event.wait()
-        bet_amount = clients[client]['msgs'][-1]
-        try:
-            bet_amount = int(bet_amount)
-        except ValueError:
-            broadcast_targeted("Please enter a number", client, None, "SERVER-MSG")
-            continue
-        if clients[client]["chips"] < bet_amount:
-            broadcast_targeted("Insufficient chips", client, None, "SERVER-MSG")
-            continue
-        else:
-            add_to_pot(client, bet_amount)
-            game_state["current_bet"] = bet_amount
-            break
-    broadcast(f"{clients[client]['name']} bets {bet_amount}", None, "SERVER-MSG")
-    return
 
+def named(request, name):
+    # The gateway's answer to a reserve_name
+    future = name_requests.pop(request, None)
+    if future is not None and not future.done():
+        future.set_result(name)
 
-def start_betting():
-    # Check to see if all players (or all but one) are all in
-    all_ins = sum(1 for client in game_state["players"] if clients[client]["chips"] == 0)
-    if all_ins >= len(game_state["players"]) - 1:
-        return
 
-    cmds = {
-        "call": cmd_call,
-        "raise": cmd_raise,
-        "fold": cmd_fold,
-        "all_in": cmd_all_in,
-        "check": cmd_check,
-        "bet": cmd_bet
-    }
+def release_name(name):
+    if control is None:
+        names.discard(name)
+    else:
+        control.send(gateway.RELEASE + name.encode('utf-8'))
 
-    while True:
-        if game_state["end_count"] == len(game_state["players"]):
-            break
 
-        for client in list(game_state["players"]):
-            # Only 1 player left
-            if len(game_state["players"]) == 1 or game_state["end_count"] == len(game_state["players"]):
+def remove_client(client):
+    print(f'{clients[client]["name"]} disconnected!')
+    sessions.pop(client.token, None)
+    timers.cancel(client.expiry)
+    table = clients[client]['table']
+    if table is not None:
+        table.leave(client)
+    unwatch(client)
+    lobby_queue.leave(client)
+    name = clients[client]['name']
+    if player_store is not None and not clients[client]['bot']:
+        player_store.save({name: clients[client]['chips']})
+        # The name is only free once the stack is on disk, a login under it on another worker reads it from there
+        player_store.synced().add_done_callback(lambda future: release_name(name))
+    elif not clients[client]['bot']:
+        release_name(name)
+    frame = broadcast(f'{clients[client]["name"]} was removed!', client, protocol.TEXT,
+                      table.seats if table else lobby())
+    if table is None:
+        relay(frame)
+    del clients[client]
+    report_load()
+
+
+def detach(client):
+    # The connection dropped but the player keeps their seat for RECONNECT_GRACE seconds, meanwhile the table
+    # plays on and their turns time out
+    print(f'{clients[client]["name"]} lost connection')
+    client.transport = None
+    client.expiry = timers.arm(RECONNECT_GRACE, remove_client, client)
+    clients[client]['table'].broadcast(f"{clients[client]['name']} lost connection", protocol.SERVER_MSG)
+
+
+def resume(new_client, token):
+    # Moves the new connection onto the session it is resuming, returns the session to use from now on
+    client = sessions.get(token)
+    if client is None:
+        broadcast_targeted("Your session has expired, please reconnect", new_client, None, protocol.SERVER_MSG)
+        broadcast_targeted("", new_client, None, protocol.SESSION)
+        flush_outbox()
+        new_client.close()
+        return new_client
+    if client.transport is not None:
+        # The old connection has not noticed it is dead yet
+        client.transport.close()
+    timers.cancel(client.expiry)
+    client.expiry = None
+    client.transport = new_client.transport
+    paused.discard(client)
+    outbox.pop(client, None)
+    metrics.inc("reconnects")
+    print(f'{clients[client]["name"]} reconnected')
+
+    # Names first, then the whole state of the table in one frame
+    introduce(client)
+    table = clients[client]['table']
+    if table is not None:
+        broadcast_targeted(table.snapshot(client), client, None, protocol.SNAPSHOT)
+        table.broadcast(f"{clients[client]['name']} reconnected", protocol.SERVER_MSG)
+        if table.acting is client:
+            table.prompt_turn(client)
+    return client
+
+
+class Feed:
+    # The public side of a table for its spectators, kept off the players' path: the table only appends the frame
+    # it already encoded for its seats to a ring buffer. Every SPECTATOR_INTERVAL each spectator is written all
+    # frames past its cursor as one batch, and spectators at the same point share the same bytes. A spectator
+    # whose socket is paused keeps its cursor, once it is more than SPECTATOR_BACKLOG frames behind it skips
+    # ahead to the oldest frame still kept
+
+    def __init__(self):
+        self.frames = deque(maxlen=SPECTATOR_BACKLOG)
+        self.published = 0  # frames published so far, the sequence number of the next one
+        self.cursors = {}  # spectator -> sequence number of the next frame it needs
+        self.timer = None
+
+    def publish(self, frame):
+        self.frames.append(frame)
+        self.published += 1
+        if self.cursors:
+            self.schedule()
+
+    def schedule(self):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(SPECTATOR_INTERVAL, self.pump)
+
+    def add(self, spectator):
+        self.cursors[spectator] = self.published
+
+    def remove(self, spectator):
+        self.cursors.pop(spectator, None)
+
+    def pump(self):
+        self.timer = None
+        oldest = self.published - len(self.frames)
+        batches = {}
+        for spectator, cursor in self.cursors.items():
+            if cursor == self.published or spectator.is_closing() or spectator in paused:
+                continue
+            if cursor < oldest:
+                metrics.inc("spectator_skips")
+                cursor = oldest
+            batch = batches.get(cursor)
+            if batch is None:
+                batch = batches[cursor] = protocol.encode_batch(list(islice(self.frames, cursor - oldest, None)))
+            spectator.write(batch)
+            self.cursors[spectator] = self.published
+            metrics.inc("spectator_bytes", amount=len(batch))
+
+
+def watch(client, table):
+    unwatch(client)
+    clients[client]['watching'] = table
+    table.feed.add(client)
+    # Where the hand is right now, the feed carries on from here
+    broadcast_targeted(table.snapshot(client), client, None, protocol.SNAPSHOT)
+    broadcast_targeted(f"Watching table {table.id}", client, None, protocol.SERVER_MSG)
+
+
+def unwatch(client):
+    table = clients[client]['watching']
+    if table is not None:
+        table.feed.remove(client)
+        clients[client]['watching'] = None
+
+
+def parse_action(text):
+    words = text.split()
+    if not words:
+        return Action("unknown", None)
+    amount = None
+    if len(words) > 1 and words[1].isdigit():
+        amount = int(words[1])
+    if words[0][0] == "/" and words[0][1:] in GAME_ACTIONS:
+        return Action(words[0][1:], amount)
+    if len(words) == 1 and words[0].isdigit():
+        return Action("amount", int(words[0]))
+    return Action("unknown", None)
+
+
+def drain(queue):
+    while not queue.empty():
+        queue.get_nowait()
+
+
+class Table:
+    # One poker table: its seats, the hand in progress and the betting state all live here,
+    # so a server can run any number of tables side by side on the event loop
+
+    def __init__(self, table_id, stake=None):
+        self.id = table_id
+        self.stake = stake
+        self.blinds = BLINDS if stake is None else (stake // 2, stake)
+        self.seats = []
+        self.players = []
+        self.pot = 0
+        self.current_bet = 0
+        self.rounds = 0
+        self.end_count = 0
+        self.acted = set()  # the seats counted in end_count
+        self.community = []
+        self.deck = cards.Deck()
+        self.acting = None
+        self.turn_timer = None
+        self.in_bank = False  # the acting player's turn clock has run out and their time bank is running
+        self.started = False
+        self.task = None
+        self.record = None
+        self.feed = Feed()
+
+    def broadcast(self, message, title):
+        # Everything said to the whole table is public, spectators get the same frame
+        self.feed.publish(broadcast(message, None, title, self.seats))
+
+    def sit(self, client):
+        unwatch(client)
+        self.feed.publish(protocol.encode(protocol.PLAYER, clients[client]['id'], clients[client]['name']))
+        lobby_queue.leave(client)
+        self.seats.append(client)
+        clients[client]['table'] = self
+        if self.stake is not None:
+            lobby_queue.update_table(self.id, self.stake, len(self.seats))
+        clients[client]['actions'] = asyncio.Queue(ACTION_QUEUE_SIZE)
+        self.broadcast(f"{clients[client]['name']} sat down at table {self.id}", protocol.SERVER_MSG)
+
+    def leave(self, client):
+        self.seats.remove(client)
+        clients[client]['table'] = None
+        if self.stake is not None and self.id in lobby_queue.seated:
+            # A seat opened up for whoever is waiting
+            lobby_queue.update_table(self.id, self.stake, len(self.seats))
+            schedule_matchmake()
+        if client in self.players:
+            # Treat leaving mid-hand as a fold and wake the betting loop in case it was their turn
+            self.players.remove(client)
+            if client in self.acted:
+                # A check or call from someone who is gone no longer counts towards closing the round
+                self.acted.discard(client)
+                self.end_count -= 1
+            self.log_action(client, "leave", 0)
+            drain(clients[client]['actions'])
+            clients[client]['actions'].put_nowait(Action("leave", None))
+        if self.stake is None and not self.seats and tables.get(self.id) is self:
+            # Private tables only last while someone sits at them, the hand in progress still plays out
+            del tables[self.id]
+            self.started = False
+            for spectator in list(self.feed.cursors):
+                broadcast_targeted(f"Table {self.id} has closed", spectator, None, protocol.SERVER_MSG)
+                unwatch(spectator)
+
+    def queue_action(self, client, action):
+        try:
+            clients[client]['actions'].put_nowait(action)
+        except asyncio.QueueFull:
+            broadcast_targeted("Too many actions waiting, slow down", client, None, protocol.SERVER_MSG)
+
+    def start(self):
+        self.started = True
+        if self.task is not None and not self.task.done():
+            # Still finishing a hand after /end, the same task simply keeps playing
+            return
+        self.task = asyncio.create_task(self.play())
+
+    async def send_odds(self, client):
+        hand = clients[client]["hand"]
+        if not self.started or not hand:
+            broadcast_targeted("You have not been dealt a hand", client, None, protocol.SERVER_MSG)
+            return
+        if client not in self.players:
+            broadcast_targeted("You have folded this hand", client, None, protocol.SERVER_MSG)
+            return
+        opponents = len(self.players) - 1
+        if not opponents:
+            broadcast_targeted("Everyone else has folded, the pot is yours", client, None, protocol.SERVER_MSG)
+            return
+        if not self.community and preflop_table:
+            broadcast_targeted(f"Equity {preflop_table.equity(hand, opponents):.1%} against {opponents} opponent(s) "
+                               f"(preflop table)", client, None, protocol.SERVER_MSG)
+            return
+        odds = await equity.estimate_equity_async(hand, list(self.community), opponents, ODDS_DEADLINE_MS)
+        if client not in clients:
+            return
+        if odds is None:
+            broadcast_targeted("Odds are not ready yet, try again", client, None, protocol.SERVER_MSG)
+            return
+        broadcast_targeted(f"Win {odds['win']:.1%}, tie {odds['tie']:.1%} against {opponents} opponent(s) "
+                           f"({odds['samples']} samples)", client, None, protocol.SERVER_MSG)
+
+    def snapshot(self, client):
+        time_left = 0
+        if self.acting is not None:
+            time_left = int(timers.remaining(self.turn_timer) * 1000)
+        return {
+            'table': self.id,
+            'pot': self.pot,
+            'current_bet': self.current_bet,
+            'acting': clients[self.acting]['id'] if self.acting in clients else 0,
+            'time_left_ms': time_left,
+            'seats': [(clients[seat]['id'], clients[seat]['chips'], clients[seat]['in_for'],
+                       (protocol.IN_HAND if seat in self.players else 0)
+                       | (protocol.BOT if clients[seat]['bot'] else 0)
+                       | (protocol.DISCONNECTED if seat.transport is None and not clients[seat]['bot'] else 0))
+                      for seat in self.seats],
+            'board': self.community,
+            'hole': clients[client]['hand'] if client in self.players else []
+        }
+
+    def log_action(self, client, kind, amount):
+        self.record['actions'].append((time.time(), clients[client]['id'], kind, amount))
+
+    def add_to_pot(self, client, amount):
+        clients[client]['chips'] -= amount
+        clients[client]["in_for"] += amount
+        self.pot += amount
+
+    async def ask_amount(self, client, amount, prompt):
+        # The amount typed with the action, otherwise whatever number the player enters next, None if they left
+        while amount is None:
+            broadcast_targeted(prompt, client, None, protocol.SERVER_MSG)
+            waited = time.perf_counter()
+            action = await clients[client]['actions'].get()
+            metrics.observe("decision_seconds", time.perf_counter() - waited)
+            if action.kind in ("leave", "timeout"):
+                return None
+            if action.amount is None:
+                broadcast_targeted("Please enter a number", client, None, protocol.SERVER_MSG)
+            amount = action.amount
+        return amount
+
+    async def cmd_call(self, client, amount):
+        self.add_to_pot(client, self.current_bet-clients[client]["in_for"])
+        self.end_count += 1
+        self.acted.add(client)
+        self.broadcast(f"{clients[client]['name']} calls", protocol.SERVER_MSG)
+
+    async def cmd_raise(self, client, raise_amount):
+        while True:
+            raise_amount = await self.ask_amount(client, raise_amount,
+                                                 "Enter amount to raise by (the call is already included)('#'):")
+            if raise_amount is None:
+                return
+            total_amount = raise_amount + self.current_bet-clients[client]["in_for"]
+            if clients[client]["chips"] < total_amount:
+                broadcast_targeted("Insufficient chips", client, None, protocol.SERVER_MSG)
+                raise_amount = None
+                continue
+            else:
+                self.current_bet = total_amount + clients[client]["in_for"]
+                self.add_to_pot(client, total_amount)
+                self.end_count = 1
+                self.acted = {client}
                 break
-            to_call = game_state["current_bet"] - clients[client]["in_for"]
-            # Provide available options
-            # First check if the client is all in or not (no chips left)
-            if clients[client]["chips"] != 0:
+        self.broadcast(f"{clients[client]['name']} raises by {raise_amount}", protocol.SERVER_MSG)
+        return
 
-                clients[client]['options'].append("fold")
+    async def cmd_fold(self, client, amount):
+        self.players.remove(client)
+        self.broadcast(f"{clients[client]['name']} folds", protocol.SERVER_MSG)
+
+    async def cmd_all_in(self, client, amount):
+        self.broadcast(f"{clients[client]['name']} is all in ({clients[client]['chips']} chips)", protocol.SERVER_MSG)
+        if clients[client]["chips"] > self.current_bet:
+            self.current_bet = clients[client]["chips"] + clients[client]["in_for"]
+            self.end_count = 1
+            self.acted = {client}
+        elif clients[client]["chips"] <= self.current_bet:
+            self.end_count += 1
+            self.acted.add(client)
+        self.add_to_pot(client, clients[client]["chips"])
+
+    async def cmd_check(self, client, amount):
+        self.end_count += 1
+        self.acted.add(client)
+        self.broadcast(f"{clients[client]['name']} checks", protocol.SERVER_MSG)
+
+    async def cmd_bet(self, client, bet_amount):
+        while True:
+            bet_amount = await self.ask_amount(client, bet_amount, "Enter amount to bet('#'):")
+            if bet_amount is None:
+                return
+            if clients[client]["chips"] < bet_amount:
+                broadcast_targeted("Insufficient chips", client, None, protocol.SERVER_MSG)
+                bet_amount = None
+                continue
+            else:
+                self.add_to_pot(client, bet_amount)
+                self.current_bet = bet_amount
+                self.end_count = 1
+                self.acted = {client}
+                break
+        self.broadcast(f"{clients[client]['name']} bets {bet_amount}", protocol.SERVER_MSG)
+        return
 
-                if clients[client]["chips"] > to_call:
-                    if to_call != 0:
-                        clients[client]['options'].append("call")
-                    if game_state["current_bet"] != 0:
-                        clients[client]['options'].append("raise")
-                    else:
-                        clients[client]['options'].append("bet")
+    def prompt_turn(self, client):
+        if clients[client]['bot']:
+            task = asyncio.create_task(self.bot_turn(client))
+            bot_tasks.add(task)
+            task.add_done_callback(bot_tasks.discard)
+            return
+        # Give some data, these four frames reach the client as one batch
+        broadcast_targeted(f"To call is {self.current_bet - clients[client]['in_for']}", client, None,
+                           protocol.SERVER_MSG)
+        broadcast_targeted(f"You have {clients[client]['chips']} chips", client, None, protocol.SERVER_MSG)
+
+        # Present options
+        options_string = 'OPTIONS:\n/' + '\n/'.join(clients[client]['options'])
+        broadcast_targeted(options_string, client, None, protocol.PROMPT)
+
+        # Sound alert for the player's turn
+        broadcast_targeted("", client, None, protocol.ALERT)
+
+    async def bot_turn(self, client):
+        # The decision is worked out off the event loop and comes back through the seat's action queue, like a
+        # human's typed input would
+        started = time.perf_counter()
+        kind, amount = await bots.decide(clients[client]['hand'], list(self.community), len(self.players) - 1,
+                                         self.current_bet - clients[client]['in_for'], self.pot,
+                                         clients[client]['chips'], list(clients[client]['options']), preflop_table)
+        metrics.observe("bot_decision_seconds", time.perf_counter() - started)
+        if self.acting is client:
+            self.queue_action(client, Action(kind, amount))
+
+    def turn_clock(self, client):
+        # Called by the timing wheel when the acting player's time is up: first their time bank starts, once that
+        # is gone too the betting loop is woken with a timeout in place of their action
+        if self.acting is not client or client not in clients:
+            # Their turn is over, or they were removed and their "leave" is already on its way
+            return
+        if not self.in_bank and clients[client]['time_bank'] > 0:
+            self.in_bank = True
+            self.turn_timer = timers.arm(clients[client]['time_bank'], self.turn_clock, client)
+            self.broadcast(f"{clients[client]['name']} is using their time bank ({clients[client]['time_bank']}s)",
+                           protocol.SERVER_MSG)
+            return
+        self.turn_timer = None
+        clients[client]['time_bank'] = 0
+        drain(clients[client]['actions'])
+        self.queue_action(client, Action("timeout", None))
+
+    def end_turn(self, client):
+        if self.in_bank and client in clients:
+            # Whatever is left of the bank stays for later turns
+            clients[client]['time_bank'] = round(timers.remaining(self.turn_timer))
+        timers.cancel(self.turn_timer)
+        self.turn_timer = None
+        self.in_bank = False
+        self.acting = None
+
+    def timed_out(self, client):
+        # What a player who runs out of time does: check if that costs nothing, otherwise fold
+        self.broadcast(f"{clients[client]['name']} ran out of time", protocol.SERVER_MSG)
+        return Action("check" if "check" in clients[client]['options'] else "fold", None)
+
+    async def start_betting(self):
+        # Check to see if all players (or all but one) are all in
+        all_ins = sum(1 for client in self.players if clients[client]["chips"] == 0)
+        if all_ins >= len(self.players) - 1:
+            return
+
+        # Anything typed before this round started is stale
+        for client in self.players:
+            drain(clients[client]['actions'])
+
+        cmds = {
+            "call": self.cmd_call,
+            "raise": self.cmd_raise,
+            "fold": self.cmd_fold,
+            "all_in": self.cmd_all_in,
+            "check": self.cmd_check,
+            "bet": self.cmd_bet
+        }
+
+        while True:
+            # Only 1 player left, or everyone still in has acted since the last bet. Also ends the round when the
+            # last players leave, an empty table would otherwise loop here without ever awaiting
+            if len(self.players) <= 1 or self.end_count >= len(self.players):
+                break
 
+            for client in list(self.players):
+                if len(self.players) <= 1 or self.end_count >= len(self.players):
+                    break
+                # Left the table earlier in this round
+                if client not in self.players:
+                    continue
+                to_call = self.current_bet - clients[client]["in_for"]
+                # Provide available options
+                # First check if the client is all in or not (no chips left)
+                clients[client]['options'] = []
                 if clients[client]["chips"] != 0:
-                    clients[client]['options'].append("all_in")
 
-                if to_call == 0:
-                    clients[client]['options'].append("check")
+                    clients[client]['options'].append("fold")
+
+                    if clients[client]["chips"] > to_call:
+                        if to_call != 0:
+                            clients[client]['options'].append("call")
+                        if self.current_bet != 0:
+                            clients[client]['options'].append("raise")
+                        else:
+                            clients[client]['options'].append("bet")
+
+                    if clients[client]["chips"] != 0:
+                        clients[client]['options'].append("all_in")
+
+                    if to_call == 0:
+                        clients[client]['options'].append("check")
+                else:
+                    # If player is already all in, skip their turn
+                    if client not in self.acted:
+                        self.end_count += 1
+                        self.acted.add(client)
+                    continue
+
+                self.broadcast(f"It is {clients[client]['name']}'s turn", protocol.SERVER_MSG)
+                self.acting = client
+                # One clock for the whole turn: invalid input, amount prompts and reconnects all count against it
+                self.turn_timer = timers.arm(TURN_TIMEOUT, self.turn_clock, client)
+
+                while True:
+                    self.prompt_turn(client)
+
+                    # Wait for response, only this seat's actions (and its clock) can wake us up
+                    waited = time.perf_counter()
+                    action = await clients[client]['actions'].get()
+                    metrics.observe("decision_seconds", time.perf_counter() - waited)
+                    if action.kind == "timeout":
+                        action = self.timed_out(client)
+                    if action.kind == "leave":
+                        # Left the table while it was their turn
+                        self.end_turn(client)
+                        break
+                    # Process response
+                    if action.kind in clients[client]['options']:
+                        chips = clients[client]['chips']
+                        # Raises and bets may still wait for an amount, nothing changes until it arrives
+                        await cmds[action.kind](client, action.amount)
+                        if action.kind in ("raise", "bet") and client in self.players and self.acting is client \
+                                and self.turn_timer is None and chips == clients[client]['chips']:
+                            # Time ran out while they were asked for the amount
+                            action = self.timed_out(client)
+                            await cmds[action.kind](client, None)
+                        self.end_turn(client)
+                        # A raise or bet is cut short if the player leaves while asked for the amount
+                        if client in self.players or action.kind == "fold":
+                            self.log_action(client, action.kind, chips - clients[client]['chips'])
+
+                        self.broadcast(f"The pot is {self.pot}", protocol.SERVER_MSG)
+                        break
+
+                    broadcast_targeted("Please input one of the following:", client, None, protocol.SERVER_MSG)
+            # Break out of nested loop
             else:
-                # If player is already all in, skip their turn
-                game_state["end_count"] += 1
                 continue
+            break
+        self.current_bet = 0
+        self.end_count = 0
+        self.acted = set()
+        for client in self.players:
+            clients[client]["in_for"] = 0
+
+        self.broadcast("Betting round over", protocol.SERVER_MSG)
+
+    def deal_community(self, announcement, count):
+        # Burn one, then deal count cards to the board. Every player still in the hand only has the new cards
+        # added to their hand state and is told their best hand so far
+        self.deck.deal(1)
+        new_cards = self.deck.deal(count)
+        self.broadcast(announcement, protocol.SERVER_MSG)
+        self.broadcast(new_cards, protocol.COMMUNITY)
+        self.community += new_cards
+        for client in self.players:
+            hand_state = clients[client]["hand_state"]
+            hand_state.add(new_cards)
+            broadcast_targeted(f"Your best hand: {cards.hand_name(hand_state.score)}", client, None,
+                               protocol.SERVER_MSG)
+
+    async def play_street(self, street):
+        started = time.perf_counter()
+        await self.start_betting()
+        metrics.observe("street_seconds", time.perf_counter() - started, street)
+
+    async def play(self):
+        self.rounds = 0
+        self.broadcast("Starting the round...", protocol.SERVER_MSG)
+        while self.started:
+
+            self.rounds += 1
+            self.pot = 0
+
+            # Set player positions and order, place big and small blinds (big and small blinds)
+            # Moving the button: the seat that acted first last hand acts last this hand
+            if self.seats:
+                self.seats.append(self.seats.pop(0))
+            order = []
+            for client in self.seats:
+                # Anyone who folded last hand still has their bets from it in in_for
+                clients[client]["in_for"] = 0
+                clients[client]["time_bank"] = min(TIME_BANK, clients[client]["time_bank"] + TIME_BANK_REFILL)
+                if clients[client]["chips"] == 0:
+                    broadcast_targeted("You have no more chips ;( Don't worry! Just spend more money to win it back!",
+                                       client, None, protocol.SERVER_MSG)
+                else:
+                    order.append(client)
 
-            broadcast(f"It is {clients[client]['name']}'s turn", None, "SERVER-MSG")
+            if len(order) <= 1:
+                print(f"Not enough players to start a game at table {self.id}")
+                self.started = False
+                if self.stake is not None:
+                    rebalance(self)
+                continue
 
-            while True:
-                # Give some data
-                broadcast_targeted(f"To call is {to_call}", client, None, "SERVER-MSG")
-                broadcast_targeted(f"You have {clients[client]['chips']} chips", client, None, "SERVER-MSG")
+            self.players = order.copy()
+            self.record = history.new_hand(self.id, self.rounds, [(clients[client]['id'], clients[client]['name'],
+                                                                    clients[client]['chips']) for client in order])
+
+            for count, client in enumerate(order):
+
+                if count == len(order)-2:
+                    clients[client]['role'] = "S"
+                    broadcast_targeted(f"You are the Small Blind (-{self.blinds[0]} chips)", client, None,
+                                       protocol.SERVER_MSG)
+                    # A short stack posts what it has left
+                    blind = min(self.blinds[0], clients[client]["chips"])
+                    self.add_to_pot(client, blind)
+                    self.log_action(client, "small_blind", blind)
+                elif count == len(order) - 1:
+                    clients[client]['role'] = "B"
+                    broadcast_targeted(f"You are the Big Blind (-{self.blinds[1]} chips)", client, None,
+                                       protocol.SERVER_MSG)
+                    # A short stack posts what it has left
+                    blind = min(self.blinds[1], clients[client]["chips"])
+                    self.add_to_pot(client, blind)
+                    self.log_action(client, "big_blind", blind)
+                    self.current_bet = self.blinds[1]
+                else:
+                    clients[client]['role'] = "N"
+                    broadcast_targeted("Yay, you aren't the big or small blind!", client, None, protocol.SERVER_MSG)
+
+            # Deal cards
+            self.community = []
+            self.broadcast("Shuffling deck...", protocol.SERVER_MSG)
+            self.deck.shuffle_cards()
+            for seat, client in zip(self.record['seats'], self.players):
+                clients[client]["hand"] = self.deck.deal(2)
+                clients[client]["hand_state"] = cards.HandState(clients[client]["hand"])
+                seat[3] = clients[client]["hand"]
+                broadcast_targeted(clients[client]["hand"], client, None, protocol.DEAL)
+
+            # First round of betting
+            await self.play_street("preflop")
+            # Declare flop
+            self.deal_community("Flop Incoming!", 3)
+            # Second round of betting
+            await self.play_street("flop")
+            # Declare turn
+            self.deal_community("Turn Incoming!", 1)
+            # Third round of betting
+            await self.play_street("turn")
+            # Declare river
+            self.deal_community("River Incoming!", 1)
+            # Final round of betting
+            await self.play_street("river")
+            # Determine winner and distribute chips
+            self.showdown()
+            self.record['board'] = self.community
+            self.record['pot'] = self.pot
+            if hand_log is not None:
+                hand_log.write(self.record)
+            if player_store is not None:
+                # Chips only change during a hand, so everyone dealt in is saved once it is over
+                player_store.save({clients[client]['name']: clients[client]['chips']
+                                   for client in order if client in clients and not clients[client]['bot']})
+            metrics.inc("hands")
+            self.players = []
+            if self.stake is not None:
+                rebalance(self)
+        self.players = []
+
+    def showdown(self):
+        if not self.players:
+            # Everyone left the table during the hand, nobody is left to pay
+            return
+        best_hand = 0
+        winners = []
+        started = time.perf_counter()
+        for client in self.players:
+            # Kept up to date street by street, see deal_community
+            worth = clients[client]["hand_state"].score
+            if worth > best_hand:
+                best_hand = worth
+                winners = [client]
+            elif worth == best_hand:
+                winners.append(client)
+        metrics.observe("showdown_seconds", time.perf_counter() - started)
+        if len(winners) == 1:
+            self.broadcast(f"Winner is {clients[winners[0]]['name']} with {cards.hand_name(best_hand)}!",
+                           protocol.SERVER_MSG)
+        else:
+            names = ", ".join(clients[client]['name'] for client in winners)
+            self.broadcast(f"Split pot between {names} with {cards.hand_name(best_hand)}!", protocol.SERVER_MSG)
+        # Odd chips go to the first winner in turn order
+        share, odd_chips = divmod(self.pot, len(winners))
+        for client in winners:
+            clients[client]["chips"] += share
+            self.record['winners'].append((clients[client]['id'], share))
+        clients[winners[0]]["chips"] += odd_chips
+        self.record['winners'][0] = (clients[winners[0]]['id'], share + odd_chips)
+
+
+def get_table(table_id):
+    # None for a table id that belongs to another worker
+    if table_id not in tables:
+        if gateway.table_worker(table_id, worker_count) != worker_index:
+            return None
+        tables[table_id] = Table(table_id)
+    return tables[table_id]
+
+
+def new_table(stake=None):
+    # Workers number their tables like their clients, so table ids are unique across all of them
+    table_id = next(str(number) for number in count(worker_index + 1, worker_count) if str(number) not in tables)
+    table = tables[table_id] = Table(table_id, stake)
+    if stake is not None:
+        lobby_queue.update_table(table_id, stake, 0)
+    return table
+
+
+def schedule_matchmake():
+    global matchmake_pending
+    if not matchmake_pending:
+        matchmake_pending = True
+        asyncio.get_running_loop().call_soon(matchmake)
+
+
+def matchmake():
+    # Seats everyone waiting: at the fullest table of their stake that has room, or at a new one once enough
+    # players are waiting. Tables start as soon as they have enough players
+    global matchmake_pending
+    matchmake_pending = False
+    for stake in STAKES:
+        seated = set()
+        while lobby_queue.waiting_count(stake):
+            table_id = lobby_queue.fullest_open(stake)
+            if table_id is None:
+                if lobby_queue.waiting_count(stake) < MIN_PLAYERS:
+                    break
+                table_id = new_table(stake).id
+            client = lobby_queue.pop_player(stake)
+            tables[table_id].sit(client)
+            seated.add(tables[table_id])
+        for table in seated:
+            if not table.started and len(table.seats) >= MIN_PLAYERS:
+                table.start()
+
+
+def rebalance(table):
+    # Between hands, a table down to half its seats or less is broken up when the other tables at its stake can
+    # take everyone, so players are not left waiting short-handed while there is room elsewhere
+    players = len(table.seats)
+    if players > lobby_queue.table_size // 2:
+        return
+    if lobby_queue.free_seats(table.stake) - (lobby_queue.table_size - players) < players:
+        return
+    lobby_queue.remove_table(table.id)
+    del tables[table.id]
+    table.started = False
+    target = None
+    for client in list(table.seats):
+        table.leave(client)
+        target = tables[lobby_queue.fullest_open(table.stake)]
+        target.sit(client)
+        broadcast_targeted(f"Moved to table {target.id} to fill it up", client, None, protocol.SERVER_MSG)
+        if not target.started and len(target.seats) >= MIN_PLAYERS:
+            target.start()
+    # Spectators follow the players, to the last table any of them went to
+    for spectator in list(table.feed.cursors):
+        broadcast_targeted(f"Table {table.id} has closed", spectator, None, protocol.SERVER_MSG)
+        if target is None:
+            unwatch(spectator)
+        else:
+            watch(spectator, target)
+    metrics.inc("rebalances")
 
-                # Present options
-                options_string = 'OPTIONS:\n/' + '\n/'.join(clients[client]['options'])
-                broadcast_targeted(options_string, client, None, "PROMPT")
 
-                # Sound alert for the player's turn
-                broadcast_targeted("", client, None, "ALERT")
+def table_summary():
+    lines = [f"Table {table.id}: {'stake ' + str(table.stake) if table.stake else 'private'}, {len(table.seats)} "
+             f"seated, {len(table.feed.cursors)} watching, {'playing' if table.started else 'waiting'}"
+             for table in tables.values()]
+    lines += [f"Stake {stake}: {lobby_queue.waiting_count(stake)} waiting" for stake in STAKES
+              if lobby_queue.waiting_count(stake)]
+    return "\n".join(lines) or "No tables"
 
-                # Wait for response
-                msg_event.wait()
-                message = clients[client]['msgs'][-1]
-                # Process response
-                if message[0] == "/":
-                    cmd = message[1:]
-                    if cmd in clients[client]['options']:
-                        cmds[cmd](client)
-                        clients[client]['options'] = []
-                        msg_event.clear()
 
-                        broadcast(f"The pot is {game_state['pot']}", None, "SERVER-MSG")
-                        break
+def chat_command(client, message):
+    # Commands available to players that are not in a hand
+    args = message[1:].split()
+    if not args:
+        return
+    table = clients[client]['table']
+    if args[0] == "tables":
+        broadcast_targeted(table_summary(), client, None, protocol.SERVER_MSG)
+    elif args[0] == "join" and len(args) == 2:
+        if table is not None:
+            broadcast_targeted(f"You are already sitting at table {table.id}", client, None, protocol.SERVER_MSG)
+            return
+        # Players only sit down at tables that are already there, new ones come from the console and the matchmaker
+        table = tables.get(args[1])
+        if table is None and gateway.table_worker(args[1], worker_count) != worker_index:
+            broadcast_targeted(f"Table {args[1]} is not on this server", client, None, protocol.SERVER_MSG)
+        elif table is None:
+            broadcast_targeted(f"There is no table {args[1]}, see /tables", client, None, protocol.SERVER_MSG)
+        elif len(table.seats) >= lobby_queue.table_size:
+            broadcast_targeted(f"Table {table.id} is full", client, None, protocol.SERVER_MSG)
+        else:
+            table.sit(client)
+    elif args[0] == "queue":
+        # Wait for a seat at the chosen stake, the matchmaker seats players as soon as there is room
+        if table is not None:
+            broadcast_targeted(f"You are already sitting at table {table.id}", client, None, protocol.SERVER_MSG)
+        elif len(args) == 2 and args[1].isdigit() and int(args[1]) in STAKES:
+            lobby_queue.join(client, int(args[1]), time.monotonic())
+            broadcast_targeted(f"Waiting for a seat at stake {args[1]} "
+                               f"({lobby_queue.waiting_count(int(args[1]))} waiting)", client, None,
+                               protocol.SERVER_MSG)
+            schedule_matchmake()
+        else:
+            broadcast_targeted("Choose a stake: " + ", ".join(str(stake) for stake in STAKES), client, None,
+                               protocol.SERVER_MSG)
+    elif args[0] == "unqueue":
+        if lobby_queue.leave(client):
+            broadcast_targeted("You left the queue", client, None, protocol.SERVER_MSG)
+    elif args[0] == "watch":
+        # Spectators stay in the lobby and only receive what the whole table is told, never anyone's cards
+        if table is not None:
+            broadcast_targeted("Leave your table before watching another", client, None, protocol.SERVER_MSG)
+        elif len(args) == 2 and args[1] in tables:
+            watch(client, tables[args[1]])
+        else:
+            broadcast_targeted(table_summary(), client, None, protocol.SERVER_MSG)
+    elif args[0] == "unwatch":
+        unwatch(client)
+    elif args[0] == "leave":
+        if table is None:
+            return
+        table.leave(client)
+        table.broadcast(f"{clients[client]['name']} left the table", protocol.SERVER_MSG)
+
+
+def handle(client, message):
+    if message['type'] != protocol.INPUT:
+        return
+
+    print(f'Received message from {clients[client]["name"]}: {message["data"]}')
+    table = clients[client]['table']
+
+    # Leaving for good, a connection that just drops keeps its seat for a while
+    if message['data'] == "/quit":
+        remove_client(client)
+        client.close()
+        return
+
+    # Odds are answered in their own task so neither this client's reads nor the betting loop wait on them
+    if message['data'] == "/odds":
+        if table is not None:
+            asyncio.create_task(table.send_odds(client))
+        return
 
-                broadcast_targeted("Please input one of the following:", client, None, "SERVER-MSG")
-                msg_event.clear()
-        # Break out of nested loop
+    if table is not None and client in table.players:
+        # Players in a hand only send actions, queued on their own seat
+        table.queue_action(client, parse_action(message['data']))
+    else:
+        # Chat room, players at a table only chat with that table
+        if message['data'][0] == "/":
+            chat_command(client, message['data'])
+        elif table is None and control is not None and len(message['data'].encode('utf-8')) > gateway.MAX_RELAYED:
+            # The other workers' lobbies could not be sent this, so nobody is
+            broadcast_targeted("Message too long", client, None, protocol.SERVER_MSG)
         else:
-            continue
-        break
-    game_state["current_bet"] = 0
-    game_state["end_count"] = 0
-    for client in game_state["players"]:
-        clients[client]["in_for"] = 0
+            frame = broadcast(message["data"], client, protocol.TEXT, lobby() if table is None else table.seats)
+            if table is None:
+                relay(frame)
+
+
+async def receive(client, name):
+    # The client sent HELLO with its nickname. The bankroll is read on the store's thread, the event loop carries
+    # on meanwhile
+    name = await reserve_name(name[:NAME_LIMIT])
+    chips = STARTING_CHIPS if player_store is None else await player_store.chips(name, STARTING_CHIPS)
+    if client.is_closing():
+        # Gone before they were logged in
+        release_name(name)
+        return
 
-    broadcast("Betting round over", None, "SERVER-MSG")
+    # Make new player/client
+    user = new_user(name, chips)
+    # Tell the new player who everyone is, then introduce them to everyone but spectators, who only learn the
+    # names of players sitting down at the table they watch
+    introduce(client)
+    clients[client] = user
+    sessions[client.token] = client
+    report_load()
+    relay(broadcast(user['name'], client, protocol.PLAYER, [c for c in clients if clients[c]['watching'] is None]))
+    # The token lets this player take their seat back after a dropped connection
+    broadcast_targeted(client.token, client, None, protocol.SESSION)
+    print('Accepted new connection from {}:{}, username: {}'.format(*client.get_extra_info('peername')[:2],
+                                                                    user['name']))
+
+    # Send "..." has joined the server
+    relay(broadcast("{} joined!".format(user['name']), client, protocol.TEXT, lobby()))
+
+
+class ClientConnection(asyncio.BufferedProtocol):
+    # The event loop reads each socket straight into its FrameDecoder, in chunks as large as the buffer has room
+    # for, and every complete frame is handled as soon as it is in. Clients are keyed by the Session, which a
+    # RESUME frame swaps for the one the player had before their connection dropped
+
+    def __init__(self, received=b""):
+        self.decoder = protocol.FrameDecoder()
+        self.transport = None
+        self.session = None
+        # What the gateway already read from a connection it handed over
+        self.received = received
+        # Frames that arrive while the login is still waiting for the bankroll
+        self.login = None
+        self.early = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.session = Session(transport)
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        metrics.inc("connections")
+        print("Connected with {}".format(str(transport.get_extra_info('peername'))))
+        if self.received:
+            self.decoder.feed(self.received)
+            self.received = b""
+            self.handle_frames()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        self.handle_frames()
+
+    def handle_frames(self):
+        try:
+            for msg_type, sender, payload in self.decoder.frames():
+                title = protocol.TITLES.get(msg_type, "")
+                metrics.inc("frames_in", title)
+                metrics.inc("bytes_in", title, protocol.HEADER.size + len(payload))
+                message = {'type': msg_type, 'data': protocol.decode_payload(msg_type, payload)}
+                if self.session in clients:
+                    handle(self.session, message)
+                elif self.login is not None:
+                    self.early.append(message)
+                elif msg_type == protocol.RESUME:
+                    self.session = resume(self.session, message['data'])
+                elif msg_type == protocol.HELLO:
+                    self.login = asyncio.create_task(self.log_in(message['data']))
+                else:
+                    # Client should send name right away, everything after that goes to handle
+                    self.transport.close()
+                if self.transport.is_closing():
+                    break
+        except Exception as e:
+            print(f'Error in handling message: {e}')
+            self.transport.close()
+
+    async def log_in(self, name):
+        try:
+            await receive(self.session, name)
+            early, self.early = self.early, []
+            for message in early:
+                if self.session not in clients or self.transport.is_closing():
+                    break
+                handle(self.session, message)
+        except Exception as e:
+            print(f'Error in handling message: {e}')
+            self.transport.close()
+
+    def pause_writing(self):
+        # The socket is not taking data as fast as we produce it, hold this client's frames in the outbox
+        paused.add(self.session)
+
+    def resume_writing(self):
+        paused.discard(self.session)
+        if self.session in outbox:
+            schedule_flush()
+        if self.session in clients and clients[self.session]['watching'] is not None:
+            clients[self.session]['watching'].feed.schedule()
+
+    def connection_lost(self, exc):
+        # Client closed the connection, for example using socket.close() or socket.shutdown(socket.SHUT_RDWR)
+        metrics.inc("disconnects")
+        if self.session.transport is not self.transport:
+            # This session has already moved on to a newer connection
+            return
+        paused.discard(self.session)
+        outbox.pop(self.session, None)
+        if self.session not in clients:
+            return
+        if clients[self.session]['table'] is not None:
+            detach(self.session)
+        else:
+            remove_client(self.session)
 
 
 def evaluate_hand(hand, community):
-    # Each hand will be associated with a numeric code to determine its worth
-    # Template: (hand) (card 1) (card 2) (card 3) (card 4) (card 5) (suit)
-    # Ex code: 10 14 13 12 11 10 4 (Royal Flush)
-
-    cards_total = hand + community
-    cards_combs = combinations(cards_total, 5)
-    value = 0
-
-    # Evaluate hand
-    hands = {
-        "royal flush": cards.check_royal_flush,
-        "straight flush": cards.check_straight_flush,
-        "4 pair": cards.check_four_kind,
-        "full house": cards.check_full_house,
-        "flush": cards.check_flush,
-        "straight": cards.check_straight,
-        "3 pair": cards.check_three_kind,
-        "2 pair": cards.check_two_pair,
-        "1 pair": cards.check_one_pair,
-        "high card": cards.check_high_card
-    }
-    hand_value = 0
-    best_hand = None
-    for cards_comb in cards_combs:
-        cards_comb = sorted(cards_comb, key=lambda crd: crd.value)
-        for hand in hands:
-            test_hand_value = hands[hand](cards_comb)
-            if test_hand_value > hand_value:
-                hand_value = test_hand_value
-                best_hand = cards_comb.copy()
-    value += hand_value
-
-    # Evaluate each card's value in hand
-    best_hand = sorted(best_hand, key=lambda e: sum(c.value == e.value for c in best_hand), reverse=True)
-    for crd in best_hand:
-        value *= 100
-        value += crd.value
-
-    # Evaluate suit's worth (of the best card in the hand)
-    value *= 10
-    value += best_hand[-1].suit_value()
-
-    return value
-
-
-def start_game():
-    global game_started
-    game_started = True
-    order = []
-    game_state["rounds"] = 0
+    # Each hand is scored with the lookup tables in cards, higher scores are better hands
+    # and equal scores are equal hands (see cards.evaluate for the layout of the score)
+    return cards.evaluate(hand + community)
+
+
+def evaluate_hands(hands):
+    # Batch version of evaluate_hand for an (N, 7) array of card ids (hole cards + community), needs numpy
+    return cards.evaluate_batch(hands)
+
+
+def add_chips(name, amount):
     for client in clients:
-        order.append(client)
-    while game_started:
-
-        game_state["rounds"] += 1
-        game_state["pot"] = 0
-
-        # Set player positions and order, place big and small blinds (big and small blinds)
-        for client in clients:
-            if clients[client]["chips"] == 0 and client in order:
-                broadcast_targeted("You have no more chips ;( Don't worry! Just spend more money to win it back!",
-                                   client, None, "SERVER-MSG")
-                order.remove(client)
-
-        if len(order) <= 1:
-            print("Not enough players to start a game")
-            game_started = False
-            continue
-
-        order.append(order.pop(0))
-        game_state["players"] = order.copy()
-
-        for count, client in enumerate(order):
-
-            if count == len(order)-2:
-                clients[client]['role'] = "S"
-                broadcast_targeted("You are the Small Blind (-1 chips)", client, None, "SERVER-MSG")
-                add_to_pot(client, 1)
-            elif count == len(order) - 1:
-                clients[client]['role'] = "B"
-                broadcast_targeted("You are the Big Blind (-2 chips)", client, None, "SERVER-MSG")
-                add_to_pot(client, 2)
-                game_state["current_bet"] = 2
-            else:
-                clients[client]['role'] = "N"
-                broadcast_targeted("Yay, you aren't the big or small blind!", client, None, "SERVER-MSG")
-
-        # Deal cards
-        deck = cards.Deck()
-        broadcast("Shuffling deck...", None, "SERVER-MSG")
-        deck.shuffle_cards()
-        for client in game_state["players"]:
-            clients[client]["hand"] = deck.deal(2)
-            broadcast_targeted(clients[client]["hand"], client, None, "DEAL")
-
-        # First round of betting
-        start_betting()
-        # Declare flop
-        deck.deal(1)
-        flop = deck.deal(3)
-        broadcast("Flop Incoming!", None, "SERVER-MSG")
-        broadcast(flop, None, "COMMUNITY")
-        # Second round of betting
-        start_betting()
-        # Declare turn
-        deck.deal(1)
-        turn = deck.deal(1)
-        broadcast("Turn Incoming!", None, "SERVER-MSG")
-        broadcast(turn, None, "COMMUNITY")
-        # Third round of betting
-        start_betting()
-        # Declare river
-        deck.deal(1)
-        river = deck.deal(1)
-        broadcast("River Incoming!", None, "SERVER-MSG")
-        broadcast(river, None, "COMMUNITY")
-        # Final round of betting
-        start_betting()
-        # Determine winner and distribute chips
-        community = flop + turn + river
-        best_hand = 0
-        winner = game_state["players"][0]
-        for client in game_state["players"]:
-            worth = evaluate_hand(clients[client]["hand"], community)
-            if worth > best_hand:
-                best_hand = worth
-                winner = client
-        broadcast(f"Winner is {clients[winner]['name']}!", None, "SERVER-MSG")
-        clients[winner]["chips"] += game_state["pot"]
-        # Another round?
-        print("Type /end to end game, otherwise begin another round!")
-        if input() == "/end":
-            game_started = False
+        if clients[client]["name"] == name:
+            clients[client]["chips"] += amount
+            if player_store is not None:
+                player_store.save({name: clients[client]["chips"]})
+            return
+    # Not connected, top up the saved bankroll
+    if player_store is not None:
+        player_store.add(name, amount, STARTING_CHIPS)
+
+
+async def command():
+    while True:
+        cmd = await admin_lines.get()
+        args = cmd.split()
+        try:
+            if cmd == "/test":
+                print("Hello World!")
+            elif cmd == "/tables":
+                print(table_summary())
+            elif cmd == "/stats":
+                print(metrics.summary())
+            elif cmd == "/shutdown":
+                return
+            elif args and args[0] == "/start":
+                if len(args) == 1:
+                    # Seat everyone in the lobby at a new table
+                    table = new_table()
+                    for client in lobby():
+                        table.sit(client)
+                else:
+                    table = get_table(args[1])
+                if table is None:
+                    print(f"Table {args[1]} is not on this worker")
+                elif table.started:
+                    print(f"Table {table.id} is already playing")
+                else:
+                    table.start()
+            elif args and args[0] == "/bots" and len(args) in (2, 3):
+                # Fills a table with bots, they take their seats when the next hand starts
+                bot_count = int(args[2]) if len(args) == 3 else 1
+                table = get_table(args[1])
+                if table is None:
+                    print(f"Table {args[1]} is not on this worker")
+                    continue
+                for _ in range(bot_count):
+                    add_bot(table)
+                print(f"Table {table.id}: {len(table.seats)} seated")
+            elif args and args[0] == "/end" and len(args) == 2:
+                if args[1] in tables:
+                    # The table finishes the hand in progress, then stops
+                    tables[args[1]].started = False
+            elif cmd == "/add_chips":
+                print("To who?")
+                name = await admin_lines.get()
+                print("How much? (#)")
+                add_chips(name, int(await admin_lines.get()))
+            elif args and args[0] == "/add_chips" and len(args) > 2:
+                # All on one line, the way the gateway passes it on: the name is everything up to the amount
+                name, amount = cmd.split(" ", 1)[1].rsplit(" ", 1)
+                add_chips(name, int(amount))
+        except (ValueError, IndexError):
+            # A typo on the console only costs that command, the tables carry on
+            print("Usage: " + ADMIN_USAGE.get(args[0], cmd))
+
+
+def console_ready():
+    global console_pending
+    data = os.read(sys.stdin.fileno(), protocol.READ_SIZE)
+    if not data:
+        asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+        return
+    *lines, console_pending = (console_pending + data).split(b"\n")
+    for line in lines:
+        admin_lines.put_nowait(str(line, 'utf-8', 'replace').rstrip("\r"))
+
+
+def watch_console(loop):
+    # The console is read on the event loop wherever stdin can be watched, so nothing is left blocked in input()
+    # at shutdown, where the interpreter would abort on its way out. Elsewhere (Windows, stdin from a file)
+    # input() gets its own thread
+    try:
+        loop.add_reader(sys.stdin.fileno(), console_ready)
+    except (NotImplementedError, OSError, ValueError):
+        threading.Thread(target=read_admin, args=(loop,), daemon=True).start()
 
 
-def command():
+def read_admin(loop):
+    # input() blocks, so the console gets the only thread besides the event loop
     while True:
-        cmd = input()
-        if cmd == "/test":
-            print("Hello World!")
-        elif cmd == "/start":
-            broadcast("Starting the round...", None, "SERVER-MSG")
-            start_game()
-        elif cmd == "/add_chips":
-            print("To who?")
-            name = input()
-            print("How much? (#)")
-            for client in clients:
-                if clients[client]["name"] == name:
-                    clients[client]["chips"] += int(input())
-
-
-print("Starting Server...")
-server_thread = threading.Thread(target=receive)
-server_thread.start()
-command_thread = threading.Thread(target=command)
-command_thread.start()
+        try:
+            line = input()
+        except EOFError:
+            break
+        loop.call_soon_threadsafe(admin_lines.put_nowait, line)
+
+
+def adopt(sock, received):
+    # A connection handed over by the gateway, served like one accepted here
+    asyncio.create_task(asyncio.get_running_loop().connect_accepted_socket(lambda: ClientConnection(received), sock))
+
+
+def read_control(loop):
+    # Worker mode: the gateway's packets take the place of both the listening socket and the console
+    while True:
+        try:
+            packet, fds, flags, address = socket.recv_fds(control, gateway.PACKET_SIZE, 1)
+        except OSError:
+            packet, fds = b"", []
+        if not packet:
+            # The gateway is gone
+            loop.call_soon_threadsafe(admin_lines.put_nowait, "/shutdown")
+            break
+        kind = packet[:1]
+        if kind == gateway.HANDOFF and fds:
+            loop.call_soon_threadsafe(adopt, socket.socket(fileno=fds[0]), packet[1:])
+        elif kind == gateway.RELAY:
+            loop.call_soon_threadsafe(relayed, packet[1:])
+        elif kind == gateway.NAME:
+            request, name = str(packet[1:], 'utf-8').split(" ", 1)
+            loop.call_soon_threadsafe(named, int(request), name)
+        elif kind == gateway.ADMIN:
+            loop.call_soon_threadsafe(admin_lines.put_nowait, str(packet[1:], 'utf-8'))
+
+
+async def main():
+    global hand_log, player_store
+    if control is None:
+        hand_log = history.HandLog()
+    else:
+        # Segment numbers are only unique within one process, so every worker logs to its own directory
+        hand_log = history.HandLog(os.path.join(history.LOG_DIR, f"worker{worker_index}"))
+    player_store = store.PlayerStore()
+    equity.start_pool()
+    loop = asyncio.get_running_loop()
+    try:
+        # Terminated (by the gateway, loadtest --spawn or kill) the way /shutdown stops: the stores are closed and
+        # the pool workers told to exit, killed outright they would be left running with nothing to serve
+        loop.add_signal_handler(signal.SIGTERM, admin_lines.put_nowait, "/shutdown")
+    except NotImplementedError:
+        pass
+    if control is None:
+        server = await loop.create_server(ClientConnection, host, port)
+    else:
+        server = None
+    await metrics.serve("127.0.0.1", metrics_port + worker_index)
+    metrics.gauge("clients", lambda: len(clients))
+    metrics.gauge("tables_playing", lambda: sum(1 for table in tables.values() if table.started))
+    metrics.gauge("spectators", lambda: sum(len(table.feed.cursors) for table in tables.values()))
+    metrics.gauge("timers", lambda: timers.count)
+    if server is None:
+        print(f"Starting worker {worker_index}...")
+        threading.Thread(target=read_control, args=(loop,), daemon=True).start()
+    else:
+        print("Starting Server...")
+        watch_console(loop)
+    try:
+        if server is None:
+            await command()
+        else:
+            async with server:
+                await command()
+    finally:
+        hand_log.close()
+        player_store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Poker server")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run this many worker processes behind one listening port (needs Unix sockets)")
+    parser.add_argument("--capacity", type=int, default=gateway.CAPACITY,
+                        help="clients a worker takes before new players go to the next one (default %(default)s)")
+    parser.add_argument("--worker", nargs=3, type=int, metavar=("INDEX", "COUNT", "FD"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers:
+        gateway.run(args.workers, host, port, args.capacity)
+    else:
+        if args.worker:
+            worker_index, worker_count, control_fd = args.worker
+            control = socket.socket(fileno=control_fd)
+        asyncio.run(main())
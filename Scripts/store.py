@@ -0,0 +1,108 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Player bankrolls by nickname, in SQLite with write-ahead logging. Players are looked up one at a time when
+# they connect, nothing is read at startup. Chip counts are only written at hand boundaries: save() queues
+# the stacks and a writer thread commits everything queued since its last pass in one transaction. Lookups go
+# through the same thread and come back as futures, so the event loop never waits on SQLite and a lookup
+# always sees every save queued before it
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "players.db")
+
+UPSERT = ("INSERT INTO players (name, chips, updated) VALUES (?, ?, ?) "
+          "ON CONFLICT (name) DO UPDATE SET chips = excluded.chips, updated = excluded.updated")
+ADD = ("INSERT INTO players (name, chips, updated) VALUES (?, ?, ?) "
+       "ON CONFLICT (name) DO UPDATE SET chips = chips + ?, updated = excluded.updated")
+
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints: a crash can lose the last commits but never corrupts
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+class PlayerStore:
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        connection = connect(path)
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS players ("
+                               "name TEXT PRIMARY KEY, chips INTEGER NOT NULL, updated REAL NOT NULL)")
+        connection.close()
+        self.changes = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def chips(self, name, default):
+        # Future for the saved stack of name, default for a player we have not seen before
+        future = asyncio.get_running_loop().create_future()
+        self.changes.put(("chips", name, default, future))
+        return future
+
+    def save(self, stacks):
+        # stacks maps names to chips, copied so the caller can keep changing its own dict
+        self.changes.put(("save", dict(stacks)))
+
+    def synced(self):
+        # Future that is done once everything queued so far is committed
+        future = asyncio.get_running_loop().create_future()
+        self.changes.put(("synced", future))
+        return future
+
+    def add(self, name, amount, default):
+        # Adds amount to a saved stack in the database itself, a player we have not seen before gets default
+        self.changes.put(("add", name, amount, default))
+
+    def close(self):
+        # Commits whatever is still queued, then stops the writer thread
+        self.changes.put(None)
+        self.thread.join()
+
+    def run(self):
+        connection = connect(self.path)
+        while True:
+            batch = [self.changes.get()]
+            while True:
+                try:
+                    batch.append(self.changes.get_nowait())
+                except queue.Empty:
+                    break
+            # Everything in the order it was queued, lookups are answered once the transaction is committed
+            answers = []
+            now = time.time()
+            with connection:
+                for change in batch:
+                    if change is None:
+                        continue
+                    if change[0] == "save":
+                        connection.executemany(UPSERT, [(name, chips, now) for name, chips in change[1].items()])
+                    elif change[0] == "add":
+                        name, amount, default = change[1:]
+                        connection.execute(ADD, (name, default + amount, now, amount))
+                    elif change[0] == "synced":
+                        answers.append((change[1], None))
+                    else:
+                        name, default, future = change[1:]
+                        row = connection.execute("SELECT chips FROM players WHERE name = ?", (name,)).fetchone()
+                        answers.append((future, default if row is None else row[0]))
+            for future, value in answers:
+                try:
+                    future.get_loop().call_soon_threadsafe(resolve, future, value)
+                except RuntimeError:
+                    # The event loop has already closed
+                    pass
+            if None in batch:
+                connection.close()
+                return
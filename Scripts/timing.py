@@ -0,0 +1,100 @@
+import asyncio
+import math
+
+# One hierarchical timing wheel for every timer on the server: turn clocks, time banks and reconnect grace
+# periods. Level 0 has SLOTS slots of one TICK each, every level above has SLOTS slots each covering a whole
+# turn of the level below. A timer goes into the lowest level whose range covers it and moves down a level
+# each time the wheel comes round to its slot, so arming and cancelling are a dict insert and delete however
+# many timers there are. The wheel only ticks, with one loop callback, while it holds any timers
+
+TICK = 0.1  # seconds, timers fire up to one tick late
+SLOTS = 64
+LEVELS = 4  # 64 ** 4 ticks, about 19 days at 0.1s
+
+
+class Timer:
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires  # tick number it fires on
+        self.callback = callback
+        self.args = args
+        self.slot = None  # the dict it is filed in, None once fired or cancelled
+
+
+class TimingWheel:
+
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.wheels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.now = 0  # ticks gone by
+        self.count = 0
+        self.started = 0.0  # loop time of tick 0
+        self.handle = None
+
+    def arm(self, delay, callback, *args):
+        # Calls callback(*args) once delay seconds have passed, returns the Timer to cancel it with
+        loop = asyncio.get_running_loop()
+        if self.handle is None:
+            # Idle until now, carry on counting ticks from here
+            self.started = loop.time() - self.now * self.tick
+            self.handle = loop.call_later(self.tick, self.run)
+        timer = Timer(self.now + max(1, math.ceil(delay / self.tick)), callback, args)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self.count -= 1
+
+    def remaining(self, timer):
+        # Seconds until the timer fires, 0 when it already has or was cancelled
+        if timer is None or timer.slot is None:
+            return 0.0
+        return (timer.expires - self.now) * self.tick
+
+    def place(self, timer):
+        level = 0
+        while level < LEVELS - 1 and timer.expires - self.now >= SLOTS ** (level + 1):
+            level += 1
+        timer.slot = self.wheels[level][timer.expires // SLOTS ** level % SLOTS]
+        timer.slot[timer] = None
+
+    def advance(self):
+        self.now += 1
+        # Every time a level comes round, the slot it reaches on the level above is spread out below it
+        for level in range(1, LEVELS):
+            if self.now % SLOTS ** level:
+                break
+            slot = self.wheels[level][self.now // SLOTS ** level % SLOTS]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self.place(timer)
+        due = self.wheels[0][self.now % SLOTS]
+        for timer in list(due):
+            # A callback can cancel timers that are due in the same tick
+            if timer.slot is due and timer.expires <= self.now:
+                del due[timer]
+                timer.slot = None
+                self.count -= 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    # Reported like any other loop callback, the rest of the wheel keeps running
+                    asyncio.get_running_loop().call_exception_handler(
+                        {'message': "Exception in timer callback", 'exception': e})
+
+    def run(self):
+        loop = asyncio.get_running_loop()
+        # Catch up on every tick that has passed, the loop may have been busy
+        target = int((loop.time() - self.started) / self.tick)
+        while self.now < target:
+            self.advance()
+        if self.count:
+            self.handle = loop.call_later(self.started + (self.now + 1) * self.tick - loop.time(), self.run)
+        else:
+            self.handle = None